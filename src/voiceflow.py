@@ -1,38 +1,84 @@
 # Standard library imports
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
 import fcntl
+import functools
+import hashlib
+import http.server
+import io
+import itertools
+import json
 import logging
+import math
 import os
+import queue
 import re
+import secrets
+import signal
+import sqlite3
 import subprocess
 import sys
 import tempfile
 import threading
 import time
+import unicodedata
+import urllib.parse
 import wave
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 # Third-party imports
-import ffmpeg
+import httpx
+import numpy as np
 import pyaudio
-import pyperclip
-import requests
-from groq import Groq
+from groq import AsyncGroq
 from pynput import keyboard
 
+try:
+    import ffmpeg  # Optional: only needed for VOICEFLOW_RESAMPLER=ffmpeg
+except ImportError:
+    ffmpeg = None
+
+try:
+    import soundfile  # Optional: FLAC/Opus upload encoding
+except ImportError:
+    soundfile = None
+
+try:
+    from Xlib import XK, X, Xatom  # Optional: in-process clipboard and key injection on X11
+    from Xlib import display as xdisplay
+    from Xlib.ext import xtest
+    from Xlib.protocol import event as xevent
+except ImportError:
+    xdisplay = None
+
+try:
+    from faster_whisper import WhisperModel  # Optional: local transcription (VOICEFLOW_LOCAL_ASR)
+except ImportError:
+    WhisperModel = None
+
 # Set up logging first
 log_file = "voiceflow.log"
 log_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 log_handler = RotatingFileHandler(log_file, maxBytes=1024 * 1024, backupCount=5)
 log_handler.setFormatter(log_formatter)
 
-logger = logging.getLogger("voiceflow")
-logger.setLevel(logging.DEBUG)
-logger.addHandler(log_handler)
-
 # Add a stream handler for console output when not running in the background
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(log_formatter)
-logger.addHandler(console_handler)
+
+# Records are handed to a listener thread that does the writing, so logging
+# never waits for the disk or the terminal on the capture or pipeline threads.
+logger = logging.getLogger("voiceflow")
+logger.setLevel(logging.DEBUG)
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, log_handler, console_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush what is still queued on exit
 
 try:
     from dotenv import load_dotenv
@@ -48,14 +94,69 @@ except Exception as e:
     logger.error(f"Error loading .env file: {e}")
     sys.exit(1)
 
+# Transcripts, prompts and LLM output are only logged at DEBUG.
+LOG_LEVEL = os.environ.get("VOICEFLOW_LOG_LEVEL", "INFO").strip().upper()
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+if LOG_LEVEL not in LOG_LEVELS:
+    logger.warning(f"Unknown VOICEFLOW_LOG_LEVEL={LOG_LEVEL!r}; using INFO")
+    LOG_LEVEL = "INFO"
+logger.setLevel(LOG_LEVEL)
+
+
+def env_flag(name, default=False):
+    """Read a boolean setting such as VOICEFLOW_WARM_STREAM=1 from the environment."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 # Constants
 CHUNK = 1024
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
-RATE = 44100
+RATE = 44100  # Used only when the input device cannot capture at TARGET_RATE
+TARGET_RATE = 16000  # Sample rate expected by the transcription APIs
+CANDIDATE_RATES = (TARGET_RATE, RATE, 48000, 32000, 22050)
 MAX_RECORD_SECONDS = 300  # 5 minutes
-WAVE_OUTPUT_FILENAME = "output.wav"
-PROCESSED_OUTPUT_FILENAME = "processed_output.wav"
+# "numpy" resamples in-process while recording; "ffmpeg" resamples after recording
+RESAMPLER = os.environ.get("VOICEFLOW_RESAMPLER", "numpy").lower()
+# Voice activity detection trims leading/trailing silence, shortens long pauses
+# and drops recordings without speech before anything is uploaded.
+VAD_ENABLED = env_flag("VOICEFLOW_VAD", default=True)
+VAD_FRAME_MS = 30
+VAD_PADDING_MS = int(os.environ.get("VOICEFLOW_VAD_PADDING_MS", "200"))  # Silence kept around speech
+VAD_MAX_PAUSE_MS = int(os.environ.get("VOICEFLOW_VAD_MAX_PAUSE_MS", "800"))  # Longer pauses are shortened
+VAD_MIN_SPEECH_MS = int(os.environ.get("VOICEFLOW_VAD_MIN_SPEECH_MS", "250"))
+VAD_FLOOR_DBFS = float(os.environ.get("VOICEFLOW_VAD_FLOOR_DBFS", "-55"))  # Never treat quieter frames as speech
+VAD_SPEECH_DBFS = float(os.environ.get("VOICEFLOW_VAD_SPEECH_DBFS", "-35"))  # Always treat louder frames as speech
+VAD_NOISE_CEILING_DBFS = -45  # Loudest plausible background level
+# Long dictations are cut at pauses while recording and each finished segment is
+# transcribed in the background, so only the last segment is pending on release.
+SEGMENTED_TRANSCRIPTION = env_flag("VOICEFLOW_SEGMENTED", default=True)
+SEGMENT_MIN_SECONDS = float(os.environ.get("VOICEFLOW_SEGMENT_MIN_SECONDS", "15"))
+SEGMENT_PAUSE_MS = int(os.environ.get("VOICEFLOW_SEGMENT_PAUSE_MS", "600"))
+
+# Upload encoding per transcription provider: "wav", "flac" (lossless) or "opus".
+# FLAC and Opus need the optional soundfile package; a provider that rejects a
+# compressed upload is retried with WAV and gets WAV from then on.
+UPLOAD_FORMATS = {
+    "wav": ("audio.wav", "audio/wav"),
+    "flac": ("audio.flac", "audio/flac"),
+    "opus": ("audio.ogg", "audio/ogg"),
+}
+DEFAULT_UPLOAD_FORMAT = "flac" if soundfile is not None else "wav"
+FIREWORKS_UPLOAD_FORMAT = os.environ.get("VOICEFLOW_FIREWORKS_UPLOAD_FORMAT", DEFAULT_UPLOAD_FORMAT).lower()
+GROQ_UPLOAD_FORMAT = os.environ.get("VOICEFLOW_GROQ_UPLOAD_FORMAT", DEFAULT_UPLOAD_FORMAT).lower()
+OPUS_COMPRESSION_LEVEL = float(os.environ.get("VOICEFLOW_OPUS_COMPRESSION_LEVEL", "0.75"))  # 0 = best, 1 = smallest
+WAV_HEADER_BYTES = 44
+
+# Warm mode keeps the input stream open between recordings and prepends the
+# last PREROLL_MS of audio when Alt+T is pressed. WARM_IDLE_SECONDS closes the
+# stream after that long without a recording (0 keeps it open indefinitely).
+WARM_STREAM = env_flag("VOICEFLOW_WARM_STREAM")
+PREROLL_MS = int(os.environ.get("VOICEFLOW_PREROLL_MS", "400"))
+WARM_IDLE_SECONDS = float(os.environ.get("VOICEFLOW_WARM_IDLE_SECONDS", "0"))
 
 # API Keys and endpoints (loaded from environment variables)
 FIREWORKS_API_KEY = os.environ.get("FIREWORKS_API_KEY", "")
@@ -65,6 +166,127 @@ OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")  # Fallback
 
 FIREWORKS_ENDPOINT = "https://audio-prod.us-virginia-1.direct.fireworks.ai/v1/audio/transcriptions"
 CEREBRAS_ENDPOINT = "https://api.cerebras.ai/v1/chat/completions"
+OPENAI_ENDPOINT = "https://api.openai.com/v1/chat/completions"
+CEREBRAS_MODEL = "llama3.1-8b"
+OPENAI_MODEL = "gpt-4"
+
+CLEANUP_PROMPT = (
+    "For the given transcription with unclear and incorrect grammar, spelling and "
+    "capitalization, return a cleaned text that is the exact representation of "
+    "the transcript but in a written form with correct grammar, spelling, "
+    "capitalization, etc. Do not add any additional text or comments. Do not "
+    "give me multiple options. ONLY output the cleaned text. "
+    "<TRANSCRIPT>{transcript}</TRANSCRIPT>"
+)
+
+# Stream the LLM cleanup and insert each sentence as soon as it is complete,
+# instead of waiting for the whole completion.
+STREAM_CLEANUP = env_flag("VOICEFLOW_STREAM_CLEANUP", default=True)
+
+# Output goes through X11 directly: VoiceFlow owns the CLIPBOARD selection and
+# pastes with XTest. Text of up to TYPE_MAX_CHARS characters is typed instead,
+# when every character is on the current keyboard layout (0 disables typing).
+TYPE_MAX_CHARS = int(os.environ.get("VOICEFLOW_TYPE_MAX_CHARS", "40"))
+# After Ctrl+V the clipboard is kept until the target window has fetched it (or
+# this many seconds have passed), so a sentence streamed in right after another
+# doesn't replace it before it is pasted.
+PASTE_FETCH_TIMEOUT = 0.5
+
+# Connections are kept alive in shared pools and re-warmed (DNS, TCP and TLS)
+# at startup and when Alt is pressed, unless warmed within HTTP_WARM_INTERVAL.
+HTTP_POOL_SIZE = 4
+HTTP_KEEPALIVE_SECONDS = 120
+HTTP_WARM_INTERVAL = float(os.environ.get("VOICEFLOW_HTTP_WARM_INTERVAL", "20"))
+
+# Hedged transcription: if the primary ASR provider has not answered within
+# HEDGE_PERCENTILE of its own recent latency, the audio is also sent to the
+# secondary and whichever answers first wins.
+HEDGE_ASR = env_flag("VOICEFLOW_HEDGE_ASR")
+HEDGE_PERCENTILE = float(os.environ.get("VOICEFLOW_HEDGE_PERCENTILE", "90"))
+HEDGE_DEFAULT_DELAY = float(os.environ.get("VOICEFLOW_HEDGE_DEFAULT_DELAY", "2.0"))  # Until enough history
+HEDGE_MIN_SAMPLES = 5
+
+# Provider routing: per-provider latency/error statistics decide the order in
+# which providers are tried. After CIRCUIT_FAILURES consecutive failures a
+# provider's circuit opens and it is skipped for CIRCUIT_COOLDOWN seconds, then
+# a single half-open probe decides whether it is healthy again. Statistics are
+# saved to ROUTER_STATE_FILE so a restart does not start cold.
+ROUTER_STATE_FILE = os.environ.get("VOICEFLOW_ROUTER_STATE", "voiceflow_router.json")
+ROUTER_EWMA_ALPHA = 0.2
+ROUTER_HISTORY = 100
+# Requests needed before expected latency is fitted as overhead + rate × size.
+ROUTER_FIT_MIN_SAMPLES = 5
+# Failures count against a provider's rank less and less, halving every ROUTER_ERROR_HALF_LIFE seconds.
+ROUTER_ERROR_HALF_LIFE = 300
+ROUTER_SAVE_INTERVAL = 10
+CIRCUIT_FAILURES = int(os.environ.get("VOICEFLOW_CIRCUIT_FAILURES", "3"))
+CIRCUIT_COOLDOWN = float(os.environ.get("VOICEFLOW_CIRCUIT_COOLDOWN", "60"))
+
+# Latency instrumentation: every dictation is timed per pipeline stage (and
+# provider); the last STAGE_HISTORY samples of each feed rolling p50/p90/p99
+# percentiles, logged on SIGUSR1.
+STAGE_HISTORY = 500
+
+# OpenMetrics endpoint at http://127.0.0.1:METRICS_PORT/metrics (0: off).
+METRICS_PORT = int(os.environ.get("VOICEFLOW_METRICS_PORT", "0"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+AUDIO_SECONDS_BUCKETS = (1, 2, 5, 10, 15, 30, 60, 120, 300)
+UPLOAD_BYTES_BUCKETS = tuple(8_000 * 2**i for i in range(11))  # 8 kB to 8 MB
+
+# Each dictation carries a trace of nested spans from the hotkey press to the
+# output. Set TRACE_FILE to write them as Chrome trace-event JSON (empty: off).
+TRACE_FILE = os.environ.get("VOICEFLOW_TRACE_FILE", "")
+
+# Deadlines: each dictation gets a latency budget of DEADLINE_BASE plus
+# DEADLINE_SLACK times the time its audio should take at the providers'
+# historical real-time factors (seconds of latency per second of audio for ASR,
+# per word for LLM cleanup). Each attempt's timeout is derived from the same
+# history and capped so the fallbacks after it still fit in the budget.
+DEADLINE_BASE = float(os.environ.get("VOICEFLOW_DEADLINE_BASE", "6"))
+DEADLINE_SLACK = float(os.environ.get("VOICEFLOW_DEADLINE_SLACK", "3"))
+DEFAULT_ASR_RTF = 0.15  # Until there is history
+DEFAULT_LLM_SECONDS_PER_WORD = 0.01
+WORDS_PER_SECOND = 2.5  # Typical dictation pace, used before the transcript exists
+WARM_AUDIO_SECONDS = 10  # Dictation length the connection warmer ranks providers for
+ATTEMPT_TIMEOUT_FACTOR = 4  # Timeout as a multiple of the expected latency
+MIN_ATTEMPT_TIMEOUT = 2.0
+MAX_ATTEMPT_TIMEOUT = 30.0
+FALLBACK_RESERVE = 0.4  # Share of the remaining budget kept back while fallbacks remain
+
+# Local CPU transcription with an int8 faster-whisper model. VOICEFLOW_LOCAL_ASR
+# is "off", "fallback" (after the network providers), "short" (first for clips
+# up to LOCAL_ASR_SHORT_SECONDS, fallback for longer ones) or "only" (offline:
+# no network transcription and no LLM cleanup).
+LOCAL_ASR = os.environ.get("VOICEFLOW_LOCAL_ASR", "off").lower()
+LOCAL_ASR_MODES = ("off", "fallback", "short", "only")
+LOCAL_ASR_MODEL = os.environ.get("VOICEFLOW_LOCAL_ASR_MODEL", "base.en")  # tiny(.en), base(.en) or small(.en)
+LOCAL_ASR_THREADS = int(os.environ.get("VOICEFLOW_LOCAL_ASR_THREADS", "0"))  # 0: CTranslate2 default
+LOCAL_ASR_SHORT_SECONDS = float(os.environ.get("VOICEFLOW_LOCAL_ASR_SHORT_SECONDS", "10"))
+
+# Cleanup results are cached by transcript, prompt and model so repeated short
+# phrases skip the LLM round trip. Entries are also kept in CLEANUP_CACHE_FILE
+# (SQLite; empty for memory only) so the cache survives restarts.
+CLEANUP_CACHE_SIZE = int(os.environ.get("VOICEFLOW_CLEANUP_CACHE_SIZE", "1000"))  # 0 disables the cache
+CLEANUP_CACHE_FILE = os.environ.get("VOICEFLOW_CLEANUP_CACHE", "voiceflow_cache.db")
+CLEANUP_CACHE_MAX_WORDS = 30  # Longer transcripts rarely repeat
+
+# Local cleanup: a rule-based normalizer (whitespace, filler words, the phrase
+# replacements in REPLACEMENTS_FILE, sentence casing, terminal punctuation).
+# "auto" skips the LLM for transcripts of up to LOCAL_CLEANUP_SHORT_WORDS, and
+# for already clean ones (the normalizer changed nothing) of up to
+# LOCAL_CLEANUP_CLEAN_WORDS. "always" never calls the LLM, "off" always does.
+LOCAL_CLEANUP = os.environ.get("VOICEFLOW_LOCAL_CLEANUP", "auto").lower()
+LOCAL_CLEANUP_MODES = ("auto", "always", "off")
+LOCAL_CLEANUP_SHORT_WORDS = int(os.environ.get("VOICEFLOW_LOCAL_CLEANUP_SHORT_WORDS", "6"))
+LOCAL_CLEANUP_CLEAN_WORDS = int(os.environ.get("VOICEFLOW_LOCAL_CLEANUP_CLEAN_WORDS", "25"))
+REPLACEMENTS_FILE = os.environ.get("VOICEFLOW_REPLACEMENTS", "voiceflow_replacements.json")  # {"phrase": "replacement"}
+
+# Finished recordings wait here for the processing worker; when the queue is
+# full, new dictations are dropped instead of blocking the key handlers.
+JOB_QUEUE_SIZE = int(os.environ.get("VOICEFLOW_JOB_QUEUE_SIZE", "4"))
+# Worker threads processing jobs concurrently. Results are still inserted in
+# recording order, so a new dictation can start while earlier ones are in ASR/LLM.
+JOB_WORKERS = int(os.environ.get("VOICEFLOW_JOB_WORKERS", "2"))
 
 # Debug logging for API keys
 logger.debug(f"FIREWORKS_API_KEY: {'set' if FIREWORKS_API_KEY else 'not set'}")
@@ -74,298 +296,2535 @@ logger.debug(
 )
 logger.debug(f"OPENAI_API_KEY: {'set' if OPENAI_API_KEY else 'not set'}")
 
+# The pipeline stage (name, provider) running in the current task, and the
+# stage timings of the dictation it belongs to.
+current_stage = contextvars.ContextVar("current_stage", default=None)
+job_timings = contextvars.ContextVar("job_timings", default=None)
+# The trace of that dictation, and the span the current task is running in.
+job_trace = contextvars.ContextVar("job_trace", default=None)
+current_span = contextvars.ContextVar("current_span", default=0)
+
+
+class Metrics:
+    """Counters, gauges and fixed-bucket histograms, rendered as OpenMetrics text.
+
+    Families are declared up front with describe(); samples are keyed by
+    their label values.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}  # name -> (type, description, buckets, {labels: value or [bucket counts, sum, count]})
+
+    def describe(self, name, kind, description, buckets=None):
+        self._families[name] = (kind, description, buckets, {})
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._families[name][3]
+            samples[key] = samples.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._families[name][3][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            _, _, buckets, samples = self._families[name]
+            state = samples.get(key)
+            if state is None:
+                state = samples[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, description, buckets, samples) in self._families.items():
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"# HELP {name} {description}")
+                for key, value in samples.items():
+                    if kind == "histogram":
+                        counts, total, count = value
+                        cumulative = 0
+                        for bound, bucket_count in zip(buckets, counts):
+                            cumulative += bucket_count
+                            lines.append(f"{name}_bucket{self._labels(key, le=float(bound))} {cumulative}")
+                        lines.append(f"{name}_bucket{self._labels(key, le='+Inf')} {count}")
+                        lines.append(f"{name}_count{self._labels(key)} {count}")
+                        lines.append(f"{name}_sum{self._labels(key)} {total}")
+                    else:
+                        suffix = "_total" if kind == "counter" else ""
+                        lines.append(f"{name}{suffix}{self._labels(key)} {value}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(key, **extra):
+        pairs = list(key) + list(extra.items())
+        if not pairs:
+            return ""
+        escaped = (
+            (label, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for label, value in pairs
+        )
+        return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
+
+
+metrics = Metrics()
+metrics.describe("voiceflow_dictations", "counter", "Dictations by outcome.")
+metrics.describe("voiceflow_provider_requests", "counter", "Provider requests by provider and outcome.")
+metrics.describe("voiceflow_fallbacks", "counter", "Requests sent to another provider after one failed.")
+metrics.describe("voiceflow_hedges", "counter", "Hedged transcription requests, hedges sent and secondary wins.")
+metrics.describe("voiceflow_cleanup_cache_lookups", "counter", "Cleanup cache lookups by result.")
+metrics.describe("voiceflow_local_cleanups", "counter", "Transcripts cleaned up without the LLM.")
+metrics.describe("voiceflow_jobs", "counter", "Processing jobs by state.")
+metrics.describe("voiceflow_queue_jobs", "gauge", "Jobs waiting for a processing worker.")
+metrics.describe("voiceflow_queue_wait_seconds", "gauge", "Time jobs waited for a worker (last, avg, max).")
+metrics.describe("voiceflow_circuit_open", "gauge", "1 while a provider's circuit breaker is open.")
+metrics.describe("voiceflow_recording_seconds", "gauge", "Length of the recording in progress.")
+metrics.describe("voiceflow_stage_seconds", "histogram", "Pipeline stage latency.", LATENCY_BUCKETS)
+metrics.describe("voiceflow_audio_seconds", "histogram", "Recorded audio per dictation.", AUDIO_SECONDS_BUCKETS)
+metrics.describe("voiceflow_upload_bytes", "histogram", "Encoded audio uploaded per request.", UPLOAD_BYTES_BUCKETS)
+metrics.describe("voiceflow_queue_depth", "histogram", "Queue depth when a job is submitted.", tuple(range(10)))
+
+
+class MetricsServer:
+    """Serves metrics as OpenMetrics text on http://127.0.0.1:<port>/metrics from a background thread."""
+
+    def __init__(self, port, render):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format % args)
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Serving metrics on http://127.0.0.1:{self._server.server_port}/metrics")
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class LatencyStats:
+    """Rolling latency samples per pipeline stage and provider, summarized as percentiles."""
+
+    def __init__(self, history):
+        self._history = history
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, provider=None):
+        """Add a sample, and add it to the current dictation's breakdown if there is one."""
+        with self._lock:
+            samples = self._samples.get((stage, provider))
+            if samples is None:
+                samples = self._samples[(stage, provider)] = collections.deque(maxlen=self._history)
+            samples.append(seconds)
+        metrics.observe("voiceflow_stage_seconds", seconds, stage=stage, provider=provider or "")
+        timings = job_timings.get()
+        if timings is not None:
+            label = f"{stage}[{provider}]" if provider else stage
+            timings[label] = timings.get(label, 0.0) + seconds
+
+    def summary(self):
+        """{(stage, provider): {"count", "p50", "p90", "p99"}} in seconds, in the order stages were first seen."""
+        with self._lock:
+            samples = {key: list(values) for key, values in self._samples.items()}
+        summary = {}
+        for key, values in samples.items():
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            summary[key] = {"count": len(values), "p50": float(p50), "p90": float(p90), "p99": float(p99)}
+        return summary
+
+    def log_summary(self):
+        lines = [
+            f"  {stage + (f'[{provider}]' if provider else ''):<28} n={s['count']:<4} "
+            f"p50 {s['p50'] * 1000:8.1f} ms  p90 {s['p90'] * 1000:8.1f} ms  p99 {s['p99'] * 1000:8.1f} ms"
+            for (stage, provider), s in self.summary().items()
+        ]
+        logger.info("Stage latency:\n" + ("\n".join(lines) if lines else "  no samples yet"))
+
+
+latency_stats = LatencyStats(STAGE_HISTORY)
+
+
+class Trace:
+    """The spans of one dictation, from the hotkey press to the output.
+
+    Spans are (id, parent id, name, provider, start, end, args) tuples with
+    perf_counter() times. Span 0 is the dictation itself, added by finish().
+    """
+
+    def __init__(self):
+        self.trace_id = secrets.token_hex(8)
+        self.started_at = time.perf_counter()
+        self.spans = []
+        self.ids = itertools.count(1)
+
+    def record(self, name, start, end, provider=None, parent=None, **args):
+        """Add a span that has already ended; the parent defaults to the current span."""
+        span_id = next(self.ids)
+        self.spans.append((span_id, current_span.get() if parent is None else parent, name, provider, start, end, args))
+        return span_id
+
+    def finish(self, end, **args):
+        self.spans.append((0, None, "dictation", None, self.started_at, end, {"trace_id": self.trace_id, **args}))
+
+
+@contextlib.contextmanager
+def span(name, provider=None, **args):
+    """Record the block as a span of the current dictation's trace, nested in the current span.
+
+    Failed and cancelled blocks are kept, marked with their status.
+    """
+    trace = job_trace.get()
+    if trace is None:
+        yield
+        return
+    span_id, parent = next(trace.ids), current_span.get()
+    token = current_span.set(span_id)
+    start = time.perf_counter()
+    try:
+        yield
+    except asyncio.CancelledError:
+        args["status"] = "cancelled"
+        raise
+    except Exception as e:
+        args["status"] = "error"
+        args["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current_span.reset(token)
+        trace.spans.append((span_id, parent, name, provider, start, time.perf_counter(), args))
+
+
+async def in_trace(trace, name, coro, **args):
+    """Run a coroutine started outside a dictation's context as a span of its trace."""
+    job_trace.set(trace)
+    with span(name, **args):
+        return await coro
+
+
+class TraceWriter:
+    """Appends finished dictations to a Chrome trace-event JSON file, for Perfetto or chrome://tracing.
+
+    Each dictation is shown as a process named after its number and trace ID.
+    Spans that overlap without nesting (hedged requests, sentences inserted
+    while the LLM is still streaming) go on separate threads. The array is
+    never closed, which the format allows, so the file stays usable if
+    VoiceFlow is killed.
+    """
+
+    def __init__(self, path):
+        self._epoch = time.perf_counter()
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8")
+        self._file.write("[\n")
+        logger.info(f"Writing dictation traces to {path}")
+
+    def write(self, seq, trace):
+        label = f"Dictation {seq} ({trace.trace_id})"
+        events = [{"name": "process_name", "ph": "M", "pid": seq, "args": {"name": label}}]
+        lanes, ends, stacks = {}, {}, []  # stacks: the open (span id, end) of each lane
+        for span_id, parent, name, provider, start, end, args in sorted(trace.spans, key=lambda s: (s[4], -s[5])):
+            # Clamp to the parent, e.g. a hedged request that is still being cancelled
+            end = max(start, min(end, ends.get(parent, end)))
+            preferred = lanes.get(parent, 0)
+            for lane in [preferred] + [i for i in range(len(stacks)) if i != preferred]:
+                if lane == len(stacks):
+                    stacks.append([])
+                stack = stacks[lane]
+                while stack and stack[-1][1] <= start:
+                    stack.pop()
+                if not stack or stack[-1][0] == parent:
+                    break
+            else:
+                lane = len(stacks)
+                stacks.append([])
+            stacks[lane].append((span_id, end))
+            lanes[span_id], ends[span_id] = lane, end
+            events.append(
+                {
+                    "name": f"{name} [{provider}]" if provider else name,
+                    "cat": "provider" if provider else "stage",
+                    "ph": "X",
+                    "pid": seq,
+                    "tid": lane,
+                    "ts": round((start - self._epoch) * 1e6, 1),
+                    "dur": round((end - start) * 1e6, 1),
+                    "args": args,
+                }
+            )
+        with self._lock:
+            self._file.write("".join(json.dumps(event) + ",\n" for event in events))
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+@contextlib.contextmanager
+def stage(name, provider=None, **args):
+    """Time a pipeline stage and trace it as a span; HTTP requests made inside it are split into their own stages."""
+    token = current_stage.set((name, provider))
+    start = time.perf_counter()
+    try:
+        with span(name, provider, **args):
+            yield
+    finally:
+        latency_stats.record(name, time.perf_counter() - start, provider)
+        current_stage.reset(token)
+
+
+class TimingTransport(httpx.AsyncHTTPTransport):
+    """Records connect, upload and response-wait stages for requests made inside an "asr" or "llm" stage.
+
+    The split comes from httpcore's trace events: sending the request (headers
+    and body) is the upload, and the time from there to the response headers
+    is the provider's response time.
+    """
+
+    REQUEST_STAGES = {"asr": ("upload", "asr_response"), "llm": ("llm_request", "llm_response")}
+
+    async def handle_async_request(self, request):
+        current = current_stage.get()
+        if current is not None and current[0] in self.REQUEST_STAGES:
+            request.extensions = {**request.extensions, "trace": functools.partial(self._trace, *current, {})}
+        return await super().handle_async_request(request)
+
+    async def _trace(self, name, provider, marks, event, info):
+        now = time.perf_counter()
+        upload_stage, response_stage = self.REQUEST_STAGES[name]
+        step = event.split(".", 1)[1]  # Drop the "connection."/"http11." prefix
+        if step == "connect_tcp.started":
+            marks["connect"] = now
+        elif step == "send_request_headers.started":
+            if "connect" in marks:
+                self._record("connect", provider, marks["connect"], now)
+            marks["send"] = now
+        elif step == "send_request_body.complete":
+            self._record(upload_stage, provider, marks["send"], now)
+            marks["sent"] = now
+        elif step == "receive_response_headers.complete" and "sent" in marks:
+            self._record(response_stage, provider, marks["sent"], now)
+
+    @staticmethod
+    def _record(name, provider, start, end):
+        latency_stats.record(name, end - start, provider)
+        trace = job_trace.get()
+        if trace is not None:
+            trace.record(name, start, end, provider)
+
+
+# Shared async HTTP client: keep-alive connections to every provider host for
+# the lifetime of the process, used only from the pipeline event loop.
+http_client = httpx.AsyncClient(
+    transport=TimingTransport(
+        limits=httpx.Limits(
+            max_keepalive_connections=HTTP_POOL_SIZE * 4,  # Four provider hosts
+            keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+        )
+    )
+)
+# Retries are left to the provider fallback, which knows the deadline.
+groq_client = AsyncGroq(api_key=GROQ_API_KEY, http_client=http_client, max_retries=0) if GROQ_API_KEY else None
+
+
+class EventLoopThread:
+    """Runs the asyncio event loop for all network I/O on a background thread.
+
+    Provider requests, hedges and streams are coroutines on this one loop, so
+    concurrent requests don't each need a thread. submit() schedules a
+    coroutine from any other thread; run() also waits for its result.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="event-loop", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, coro):
+        """Schedule a coroutine and return a concurrent.futures.Future for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("EventLoopThread.run() would block its own loop; await the coroutine instead")
+        return self.submit(coro).result()
+
+    def shutdown(self):
+        self.run(http_client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+
+pipeline_loop = EventLoopThread()
+
+
+class BufferPool:
+    """Reusable capture buffers, one per dictation that is recording or being processed.
+
+    Buffers are allocated on first use (the first `preallocate` up front) and
+    kept for reuse, so steady-state recording does not allocate. acquire()
+    returns None once `size` buffers are in flight.
+    """
+
+    def __init__(self, size, max_seconds, rate, sample_width, preallocate=1):
+        self._size = size
+        self._args = (max_seconds, rate, sample_width)
+        self._lock = threading.Lock()
+        self._free = [CaptureBuffer(*self._args) for _ in range(min(preallocate, size))]
+        self._allocated = len(self._free)
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            if self._allocated >= self._size:
+                return None
+            self._allocated += 1
+        return CaptureBuffer(*self._args)
+
+    def release(self, buffer):
+        with self._lock:
+            self._free.append(buffer)
+
+
+class CaptureBuffer:
+    """Preallocated, contiguous PCM buffer that a recording is written into.
+
+    The buffer is allocated once, sized for the longest allowed recording, and
+    reused between recordings. Later stages read the captured audio through a
+    zero-copy memoryview instead of joining a list of chunks.
+    """
+
+    def __init__(self, max_seconds, rate, sample_width, channels=CHANNELS):
+        self.rate = rate
+        self.frame_bytes = sample_width * channels
+        self.capacity = int(max_seconds * rate) * self.frame_bytes
+        self._data = bytearray(self.capacity)
+        self._view = memoryview(self._data)
+        self.nbytes = 0
+
+    def reset(self):
+        self.nbytes = 0
+
+    def write(self, data):
+        """Copy a chunk into the buffer. Returns the number of bytes stored."""
+        count = min(len(data), self.capacity - self.nbytes)
+        self._view[self.nbytes : self.nbytes + count] = memoryview(data)[:count]
+        self.nbytes += count
+        return count
+
+    @property
+    def frames(self):
+        return self.nbytes // self.frame_bytes
+
+    @property
+    def seconds(self):
+        return self.frames / self.rate
+
+    @property
+    def full(self):
+        return self.nbytes >= self.capacity
+
+    def view(self):
+        """Zero-copy view of the audio captured so far."""
+        return self._view[: self.nbytes]
+
+
+@functools.lru_cache(maxsize=None)
+def polyphase_filter(up, down):
+    """Kaiser-windowed sinc low-pass filter split into `up` polyphase branches.
+
+    Uses the same design as scipy.signal.resample_poly. Row k of the result
+    holds the taps for output samples that fall on phase k, reversed so they
+    can be applied as a dot product against ascending input history.
+    """
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    n_taps = 2 * half_len + 1
+    t = np.arange(n_taps) - half_len
+    h = np.sinc(t / max_rate) * np.kaiser(n_taps, 5.0)
+    h *= up / h.sum()
+    taps_per_phase = -(-n_taps // up)
+    h = np.pad(h, (0, taps_per_phase * up - n_taps))
+    return np.ascontiguousarray(h.reshape(taps_per_phase, up).T[:, ::-1], dtype=np.float32), half_len
+
+
+class StreamingResampler:
+    """Stateful polyphase resampler for 16-bit mono PCM, fed one chunk at a time.
+
+    Filter history is carried across calls, so resampling chunks as they
+    arrive produces the same output as resampling the whole recording.
+    """
+
+    def __init__(self, in_rate, out_rate):
+        divisor = math.gcd(in_rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+        self._filter, self._delay = polyphase_filter(self.up, self.down)
+        self._taps = np.arange(self._filter.shape[1])
+        self.reset()
+
+    def reset(self):
+        self._history = np.zeros(self._filter.shape[1] - 1, dtype=np.float32)
+        # Position of the next output sample, in upsampled units relative to the
+        # start of the next chunk. Starting at the filter delay aligns the output.
+        self._offset = self._delay
+
+    def process(self, data):
+        """Resample a chunk of int16 PCM bytes and return int16 PCM bytes."""
+        chunk = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        samples = np.concatenate((self._history, chunk))
+        span = len(chunk) * self.up
+
+        count = max(0, -(-(span - self._offset) // self.down))
+        positions = self._offset + self.down * np.arange(count)
+        phases = positions % self.up
+        windows = samples[(positions // self.up)[:, None] + self._taps]
+        out = np.einsum("ij,ij->i", self._filter[phases], windows)
+
+        self._offset += self.down * count - span
+        self._history = samples[len(samples) - len(self._history) :]
+        return np.clip(np.rint(out), -32768, 32767).astype(np.int16).tobytes()
+
+
+class PrerollBuffer:
+    """Fixed-size circular buffer holding the most recent audio from a warm stream."""
+
+    def __init__(self, seconds, rate, sample_width, channels=CHANNELS):
+        self.frame_bytes = sample_width * channels
+        self.capacity = max(int(seconds * rate), 1) * self.frame_bytes
+        self._data = bytearray(self.capacity)
+        self._pos = 0
+        self.nbytes = 0
+
+    def clear(self):
+        self._pos = 0
+        self.nbytes = 0
+
+    def write(self, data):
+        data = memoryview(data)[-self.capacity :]
+        count = len(data)
+        first = min(count, self.capacity - self._pos)
+        self._data[self._pos : self._pos + first] = data[:first]
+        self._data[: count - first] = data[first:]
+        self._pos = (self._pos + count) % self.capacity
+        self.nbytes = min(self.nbytes + count, self.capacity)
+
+    def drain_into(self, buffer):
+        """Copy the buffered audio, oldest first, into buffer and clear it."""
+        start = (self._pos - self.nbytes) % self.capacity
+        view = memoryview(self._data)
+        if start + self.nbytes <= self.capacity:
+            buffer.write(view[start : start + self.nbytes])
+        else:
+            buffer.write(view[start:])
+            buffer.write(view[: self._pos])
+        self.clear()
+
+
+class CaptureService:
+    """Owns the microphone stream and serves start/stop commands on one long-lived thread.
+
+    PyAudio runs in callback mode, so audio is pulled by PortAudio's own thread
+    and copied straight into the capture buffer of the job being recorded. The
+    service thread only opens and closes the stream, reports progress and
+    feeds the job's segmenter; it never polls the device.
+
+    In warm mode the stream stays open between recordings and keeps a short
+    pre-roll of audio that is prepended to the next recording, so the first
+    syllables are not lost to device-open latency. The warm stream is closed
+    after idle_timeout seconds without a recording and reopened on demand.
+    """
+
+    def __init__(self, audio, rate, device_rate=None, resampler=None, warm=False, preroll=None, idle_timeout=0):
+        self._audio = audio
+        self.rate = rate
+        self._device_rate = device_rate or rate
+        self._resampler = resampler
+        self.preroll = preroll
+        self._warm = warm and preroll is not None
+        self._idle_timeout = idle_timeout
+        self._commands = queue.Queue()
+        self._lock = threading.Lock()
+        self._stream = None
+        self._job = None
+        self._recording = False
+        self._last_active = time.monotonic()
+        self._last_progress = 0.0
+        self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def shutdown(self):
+        self._commands.put(("shutdown", None))
+        self._thread.join()
+
+    def warm_up(self):
+        """Make sure the warm stream is open, e.g. as soon as Alt is pressed."""
+        if self._warm:
+            self._commands.put(("warm", None))
+
+    def start_recording(self, job):
+        """Record into job.buffer until stop_recording(); job.captured is set when done."""
+        self._commands.put(("start", job))
+
+    def stop_recording(self):
+        self._commands.put(("stop", None))
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        if self._resampler is not None:
+            in_data = self._resampler.process(in_data)
+        with self._lock:
+            if self._recording:
+                buffer = self._job.buffer
+                buffer.write(in_data)
+                if buffer.full:
+                    # Duration limit is enforced by frame count, not wall-clock time.
+                    self._recording = False
+                    self._commands.put(("limit", None))
+            elif self._warm:
+                self.preroll.write(in_data)
+        return (None, pyaudio.paContinue)
+
+    def _run(self):
+        while True:
+            try:
+                command, job = self._commands.get(timeout=0.25)
+            except queue.Empty:
+                self._tick()
+                continue
+
+            if command == "warm":
+                self._open_stream()
+            elif command == "start":
+                self._begin_recording(job)
+            elif command == "limit":
+                logger.info(f"Maximum recording length of {MAX_RECORD_SECONDS} seconds reached")
+                self._end_recording()
+            elif command == "stop":
+                self._end_recording()
+            elif command == "shutdown":
+                self._end_recording()
+                self._close_stream()
+                break
+
+    def _tick(self):
+        job = self._job
+        if self._recording and job is not None:
+            if job.segmenter is not None:
+                job.segmenter.poll(np.frombuffer(job.buffer.view(), dtype=np.int16), job.buffer.rate)
+            if time.monotonic() - self._last_progress >= 1.0:  # Update progress every second
+                self._last_progress = time.monotonic()
+                metrics.set("voiceflow_recording_seconds", job.buffer.seconds)
+        elif self._idle_expired():
+            logger.info(f"Closing warm input stream after {self._idle_timeout:g} idle seconds")
+            self._close_stream()
+
+    def _idle_expired(self):
+        return (
+            self._warm
+            and self._idle_timeout > 0
+            and self._stream is not None
+            and self._job is None
+            and time.monotonic() - self._last_active >= self._idle_timeout
+        )
+
+    def _begin_recording(self, job):
+        self._end_recording()
+        with self._lock:
+            job.buffer.reset()
+            if self._warm and self._stream is not None:
+                self.preroll.drain_into(job.buffer)
+            preroll_seconds = job.buffer.seconds
+            self._job = job
+            self._recording = True
+
+        if not self._open_stream():
+            with self._lock:
+                self._recording = False
+                self._job = None
+            job.captured.set()
+            return
+        logger.info(f"Recording {job.seq} started ({preroll_seconds * 1000:.0f} ms pre-roll)")
+
+    def _end_recording(self):
+        if self._job is None:
+            return
+        with self._lock:
+            self._recording = False
+            job, self._job = self._job, None
+        if not self._warm:
+            self._close_stream()
+        self._last_active = time.monotonic()
+        logger.info(
+            "Recording {} finished. Duration: {:.1f} seconds. Frames: {}".format(
+                job.seq, job.buffer.seconds, job.buffer.frames
+            )
+        )
+        job.captured_at = time.perf_counter()
+        job.captured.set()
+        metrics.set("voiceflow_recording_seconds", 0)
+
+    def _open_stream(self):
+        if self._stream is not None:
+            return True
+        if self._warm:
+            self.preroll.clear()
+        if self._resampler is not None:
+            self._resampler.reset()
+        try:
+            self._stream = self._audio.open(
+                format=FORMAT,
+                channels=CHANNELS,
+                rate=self._device_rate,
+                input=True,
+                frames_per_buffer=CHUNK,
+                stream_callback=self._callback,
+            )
+        except Exception as e:
+            logger.error(f"Error opening audio stream: {e}")
+            return False
+        self._last_active = time.monotonic()
+        return True
+
+    def _close_stream(self):
+        if self._stream is None:
+            return
+        try:
+            self._stream.stop_stream()
+            self._stream.close()
+        except Exception as e:
+            logger.error(f"Error closing audio stream: {e}")
+        self._stream = None
+
+
+def probe_input_rates(audio):
+    """Return the candidate sample rates the default input device accepts."""
+    try:
+        device_index = audio.get_default_input_device_info()["index"]
+    except (IOError, OSError) as e:
+        logger.error(f"Could not query default input device: {e}")
+        return ()
+
+    supported = []
+    for rate in CANDIDATE_RATES:
+        try:
+            if audio.is_format_supported(
+                rate,
+                input_device=device_index,
+                input_channels=CHANNELS,
+                input_format=FORMAT,
+            ):
+                supported.append(rate)
+        except ValueError:
+            pass
+    logger.debug(f"Input device supports sample rates: {supported}")
+    return tuple(supported)
+
+
+def negotiate_capture_rate(supported_rates):
+    """Capture at TARGET_RATE when possible so no resampling is needed."""
+    if TARGET_RATE in supported_rates:
+        return TARGET_RATE
+    if RATE in supported_rates or not supported_rates:
+        return RATE
+    return supported_rates[0]
+
+
+class Segmenter:
+    """Cuts a recording at natural pauses and transcribes finished segments in the background.
+
+    The capture service polls it while recording. Once SEGMENT_MIN_SECONDS of
+    audio has accumulated since the last cut, the latest pause of at least
+    SEGMENT_PAUSE_MS becomes the next cut and the audio before it is submitted
+    for transcription. finish() submits the remainder and stitches the
+    transcripts together in recording order.
+    """
+
+    def __init__(self, loop, trace=None):
+        self._loop = loop
+        self._trace = trace
+        self.reset()
+
+    def reset(self):
+        self._futures = []
+        self._cut = 0
+
+    def poll(self, samples, rate):
+        if len(samples) - self._cut < SEGMENT_MIN_SECONDS * rate:
+            return
+
+        speech, frame_len = detect_speech(samples[self._cut :], rate)
+        pause_frames = SEGMENT_PAUSE_MS // VAD_FRAME_MS
+        edges = np.diff(np.concatenate(([0], (~speech).astype(np.int8), [0])))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        # Only pauses that follow some speech are useful cut points.
+        pauses = [start for start, end in zip(starts, ends) if start > 0 and end - start >= pause_frames]
+        if not pauses:
+            return
+
+        cut = self._cut + (pauses[-1] + pause_frames // 2) * frame_len
+        self._submit(samples[self._cut : cut], rate)
+        self._cut = cut
+
+    async def finish(self, samples, rate, deadline=None):
+        """Submit the rest of the recording and return the stitched transcript."""
+        self._submit(samples[self._cut :], rate, deadline)
+        if len(self._futures) > 1:
+            logger.info(f"Waiting for {len(self._futures)} transcription segments")
+        transcripts = await asyncio.gather(*map(asyncio.wrap_future, self._futures))
+        self.reset()
+        if any(text is None for text in transcripts):
+            return None
+        return " ".join(text for text in transcripts if text)
+
+    def cancel(self):
+        """Cancel the transcription of segments already submitted."""
+        for future in self._futures:
+            future.cancel()
+        self.reset()
+
+    def _submit(self, samples, rate, deadline=None):
+        index = len(self._futures) + 1
+        logger.info(f"Submitting segment {index}: {len(samples) / rate:.2f} seconds")
+        coro = transcribe_pcm_async(samples.copy(), rate, deadline)
+        self._futures.append(self._loop.submit(in_trace(self._trace, "segment", coro, index=index)))
+
+
+class ProviderStats:
+    """Rolling latency and error statistics for one provider, and its circuit breaker."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latency_ewma = None
+        self.error_ewma = 0.0
+        self.failed_at = 0.0
+        self.latencies = collections.deque(maxlen=ROUTER_HISTORY)
+        self.samples = collections.deque(maxlen=ROUTER_HISTORY)  # (units, latency) of recent requests
+        self.consecutive_failures = 0
+        self.state = "closed"  # "closed", "open" or "half-open"
+        self.opened_at = 0.0
+        self.probe_started = None
+
+    def record_success(self, latency, units=None):
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += ROUTER_EWMA_ALPHA * (latency - self.latency_ewma)
+        if units:
+            self.samples.append((units, latency))
+        self.error_ewma *= 1 - ROUTER_EWMA_ALPHA
+        self.latencies.append(latency)
+        self.consecutive_failures = 0
+        self.probe_started = None
+        if self.state != "closed":
+            logger.info(f"{self.name} circuit closed")
+        self.state = "closed"
+
+    def record_failure(self):
+        self.error_ewma += ROUTER_EWMA_ALPHA * (1 - self.error_ewma)
+        self.failed_at = time.time()
+        self.consecutive_failures += 1
+        self.probe_started = None
+        if self.state == "half-open" or self.consecutive_failures >= CIRCUIT_FAILURES:
+            if self.state != "open":
+                logger.warning(f"{self.name} circuit opened after {self.consecutive_failures} consecutive failures")
+            self.state = "open"
+            self.opened_at = time.time()
+
+    def available(self, claim_probe=True):
+        """True if a request may be sent: closed, or due for a single half-open probe."""
+        if self.state == "open" and time.time() - self.opened_at >= CIRCUIT_COOLDOWN:
+            logger.info(f"{self.name} circuit half-open, sending a probe request")
+            self.state = "half-open"
+        if self.state == "half-open":
+            # Only one probe at a time; a probe that was never resolved expires.
+            if self.probe_started is not None and time.time() - self.probe_started < CIRCUIT_COOLDOWN:
+                return False
+            if claim_probe:
+                self.probe_started = time.time()
+            return True
+        return self.state == "closed"
+
+    def percentile(self, q):
+        return float(np.percentile(self.latencies, q)) if self.latencies else None
+
+    def recent_error_rate(self):
+        """The error EWMA, faded since the last failure so a provider that is no longer tried can recover."""
+        return self.error_ewma * 0.5 ** ((time.time() - self.failed_at) / ROUTER_ERROR_HALF_LIFE)
+
+    def latency_model(self):
+        """(overhead, rate, floor) with latency ≈ max(floor, overhead + rate × units), or None without history.
+
+        The fixed overhead (connection, queueing, model start-up) and the rate
+        per unit are fitted over recent requests. While their sizes are too
+        similar to tell the two apart, latency is taken as proportional to
+        size but never below the median, so a short request after long ones
+        is not expected to be nearly instant.
+        """
+        if not self.samples:
+            return None
+        units, latencies = np.array(self.samples, dtype=float).T
+        if len(units) >= ROUTER_FIT_MIN_SAMPLES and units.max() >= 1.5 * units.min():
+            rate, overhead = np.polyfit(units, latencies, 1)
+            if rate > 0 and overhead >= 0:
+                return float(overhead), float(rate), 0.0
+        return 0.0, float(np.mean(latencies / units)), float(np.median(latencies))
+
+    def expected_latency(self, units):
+        """Expected latency for `units` of work, or None without history."""
+        model = self.latency_model()
+        if model is None:
+            return None
+        overhead, rate, floor = model
+        return max(floor, overhead + rate * units)
+
+    def slowdown_percentile(self, q):
+        """A percentile of actual over expected latency across recent requests."""
+        model = self.latency_model()
+        if model is None:
+            return None
+        overhead, rate, floor = model
+        ratios = [latency / max(floor, overhead + rate * units) for units, latency in self.samples]
+        return float(np.percentile(ratios, q))
+
+    def to_dict(self):
+        return {
+            "latency_ewma": self.latency_ewma,
+            "error_ewma": self.error_ewma,
+            "failed_at": self.failed_at,
+            "latencies": list(self.latencies),
+            "samples": [list(sample) for sample in self.samples],
+            "consecutive_failures": self.consecutive_failures,
+            "state": "open" if self.state == "half-open" else self.state,
+            "opened_at": self.opened_at,
+        }
+
+    @classmethod
+    def from_dict(cls, name, data):
+        stats = cls(name)
+        stats.latency_ewma = data.get("latency_ewma")
+        stats.error_ewma = data.get("error_ewma", 0.0)
+        stats.failed_at = data.get("failed_at", 0.0)
+        stats.latencies.extend(data.get("latencies", []))
+        stats.samples.extend(tuple(sample) for sample in data.get("samples", []))
+        stats.consecutive_failures = data.get("consecutive_failures", 0)
+        stats.state = data.get("state", "closed")
+        stats.opened_at = data.get("opened_at", 0.0)
+        return stats
+
+
+class ProviderRouter:
+    """Orders providers by health and current latency, and persists their statistics."""
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._last_save = 0.0
+        self._load()
+
+    def stats(self, name):
+        with self._lock:
+            if name not in self._stats:
+                self._stats[name] = ProviderStats(name)
+            return self._stats[name]
+
+    def order(self, names, units, claim_probes=True):
+        """Providers to try for a request of `units` of work, in order.
+
+        A provider whose circuit is due for a half-open probe goes first, so
+        recovery is noticed. Healthy providers follow: those with latency
+        history are ranked by their expected latency at this size divided by
+        their recent success rate (the expected time to a good answer,
+        retries included; see recent_error_rate()), while those without
+        history keep their configured place among them, so they are still
+        tried and measured. Open circuits are only used as a last resort.
+        Pass claim_probes=False when only peeking at the order.
+        """
+        healthy, measured, probes, broken = [], [], [], []
+        for index, name in enumerate(names):
+            stats = self.stats(name)
+            if stats.state == "closed":
+                healthy.append(name)
+                expected = stats.expected_latency(units)
+                if expected is not None:
+                    cost = expected / max(1 - stats.recent_error_rate(), 0.1)
+                    measured.append((cost, index, name))
+            elif stats.available(claim_probes):
+                probes.append(name)
+            else:
+                broken.append(name)
+        # Measured providers swap places among themselves; the others stay put.
+        ranked = iter(name for _, _, name in sorted(measured))
+        slots = {name for _, _, name in measured}
+        healthy = [next(ranked) if name in slots else name for name in healthy]
+        return probes + healthy + broken
+
+    def record_success(self, name, latency, units=None):
+        self.stats(name).record_success(latency, units)
+        metrics.inc("voiceflow_provider_requests", provider=name, outcome="success")
+        self._maybe_save()
+
+    def record_failure(self, name):
+        self.stats(name).record_failure()
+        metrics.inc("voiceflow_provider_requests", provider=name, outcome="failure")
+        self._maybe_save()
+
+    def best_expected_latency(self, names, units):
+        """Lowest expected latency for `units` of work among healthy providers, or None without history."""
+        latencies = [self.stats(name).expected_latency(units) for name in names if self.stats(name).state == "closed"]
+        latencies = [latency for latency in latencies if latency is not None]
+        return min(latencies) if latencies else None
+
+    def summary(self):
+        with self._lock:
+            stats = list(self._stats.values())
+        return {
+            s.name: {
+                "state": s.state,
+                "latency_ewma": s.latency_ewma,
+                "p50": s.percentile(50),
+                "p95": s.percentile(95),
+                "error_rate": s.error_ewma,
+            }
+            for s in stats
+        }
+
+    def _load(self):
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load provider stats from {self._path}: {e}")
+            return
+        for name, entry in data.items():
+            self._stats[name] = ProviderStats.from_dict(name, entry)
+        logger.debug(f"Loaded provider stats for {', '.join(self._stats)}")
+
+    def _maybe_save(self):
+        if time.monotonic() - self._last_save >= ROUTER_SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        self._last_save = time.monotonic()
+        with self._lock:
+            data = {name: stats.to_dict() for name, stats in self._stats.items()}
+        try:
+            tmp_path = f"{self._path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logger.warning(f"Could not save provider stats to {self._path}: {e}")
+
+
+class Deadline:
+    """Latency budget for one dictation, shared by its transcription and cleanup attempts."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.started = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        return max(0.0, self.budget - self.elapsed())
+
+    def timeout(self, expected, fallbacks=0):
+        """Timeout for one attempt.
+
+        A multiple of the attempt's expected latency, capped at the remaining
+        budget, less a reserve while fallbacks remain so they can still start
+        in time. Never below MIN_ATTEMPT_TIMEOUT: once the budget is spent a
+        late result still beats none.
+        """
+        timeout = MAX_ATTEMPT_TIMEOUT if expected is None else expected * ATTEMPT_TIMEOUT_FACTOR
+        available = self.remaining() * (1 - FALLBACK_RESERVE if fallbacks else 1)
+        return max(MIN_ATTEMPT_TIMEOUT, min(timeout, available, MAX_ATTEMPT_TIMEOUT))
+
+
+class LocalTranscriber:
+    """Offline transcription on the CPU with a quantized (int8) faster-whisper model.
+
+    The model is loaded once, by load() or the first request, and stays
+    resident. Requests run one at a time; a single clip already uses all of
+    CTranslate2's threads.
+    """
+
+    def __init__(self, model, threads=0):
+        self.model = model
+        self._threads = threads
+        self._whisper = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._whisper is None:
+                start = time.monotonic()
+                self._whisper = WhisperModel(self.model, device="cpu", compute_type="int8", cpu_threads=self._threads)
+                logger.info(f"Loaded local Whisper model {self.model} in {time.monotonic() - start:.1f}s")
+        return self._whisper
+
+    def transcribe(self, samples):
+        """Transcribe 16 kHz int16 samples. Blocks until done."""
+        whisper = self.load()
+        audio = samples.astype(np.float32) / 32768
+        with self._lock:
+            segments, _ = whisper.transcribe(audio, language="en", beam_size=1, condition_on_previous_text=False)
+            return "".join(segment.text for segment in segments).strip()
+
+
+class CleanupCache:
+    """LRU cache of LLM cleanup results, keyed on a hash of the normalized transcript, prompt and model.
+
+    Lookups only touch the in-memory OrderedDict. With a path, entries are
+    also written to SQLite, and the `size` most recently used ones are loaded
+    at startup.
+    """
+
+    def __init__(self, size, path=None):
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._touched = {}  # Keys hit since the last write, and when
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self._open(path)
+
+    @staticmethod
+    def key(transcript, prompt, model):
+        normalized = " ".join(unicodedata.normalize("NFKC", transcript).casefold().split())
+        return hashlib.sha256("\0".join((model, prompt, normalized)).encode()).hexdigest()
+
+    def lookup(self, keys):
+        """Return the cached text for the first of `keys` present, or None."""
+        with self._lock:
+            for key in keys:
+                text = self._entries.get(key)
+                if text is not None:
+                    self._entries.move_to_end(key)
+                    self._touched[key] = time.time()
+                    self.hits += 1
+                    return text
+            self.misses += 1
+            return None
+
+    def put(self, key, text):
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+            if self._db is None:
+                return
+            try:
+                with self._db:
+                    self._save_touched()
+                    self._db.execute("INSERT OR REPLACE INTO cleanup VALUES (?, ?, ?)", (key, text, time.time()))
+                    self._db.execute(
+                        "DELETE FROM cleanup WHERE key NOT IN "
+                        "(SELECT key FROM cleanup ORDER BY last_used DESC LIMIT ?)",
+                        (self._size,),
+                    )
+            except sqlite3.Error as e:
+                logger.warning(f"Could not save cleanup cache entry: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+    def close(self):
+        if self._db is None:
+            return
+        with self._lock:
+            try:
+                with self._db:
+                    self._save_touched()
+            except sqlite3.Error as e:
+                logger.warning(f"Could not save cleanup cache: {e}")
+            self._db.close()
+            self._db = None
+
+    def _save_touched(self):
+        # Hits only update memory; their recency reaches the database here, before any trimming.
+        self._db.executemany(
+            "UPDATE cleanup SET last_used = ? WHERE key = ?",
+            [(used, key) for key, used in self._touched.items()],
+        )
+        self._touched.clear()
+
+    def _open(self, path):
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS cleanup "
+                    "(key TEXT PRIMARY KEY, text TEXT NOT NULL, last_used REAL NOT NULL)"
+                )
+            rows = self._db.execute(
+                "SELECT key, text FROM cleanup ORDER BY last_used DESC LIMIT ?", (self._size,)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not open cleanup cache {path}, keeping it in memory only: {e}")
+            self._db = None
+            return
+        for key, text in reversed(rows):
+            self._entries[key] = text
+        logger.debug(f"Loaded {len(rows)} cleanup cache entries from {path}")
+
+
+class ConnectionWarmer:
+    """Keeps connections to the primary providers open so requests skip the handshake.
+
+    warm() only wakes the warmer thread, so it is cheap enough to call from the
+    key handlers. Hosts warmed within the last `interval` seconds are skipped.
+    """
+
+    def __init__(self, loop, targets, interval):
+        self._loop = loop
+        self._targets = targets  # Callable returning (name, url, client) with an httpx.AsyncClient-style head()
+        self._interval = interval
+        self._last_warmed = {}
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="http-warmer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self.warm()
+
+    def warm(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            for name, url, client in self._targets():
+                last = self._last_warmed.get(name)
+                if last is not None and time.monotonic() - last < self._interval:
+                    continue
+                start = time.monotonic()
+                try:
+                    self._loop.run(client.head(url, timeout=5))
+                except Exception as e:
+                    logger.debug(f"Could not warm {name} connection: {e}")
+                    continue
+                self._last_warmed[name] = time.monotonic()
+                logger.debug(f"Warmed {name} connection in {(time.monotonic() - start) * 1000:.0f} ms")
+
+
+def origin(url):
+    parts = urllib.parse.urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}/"
+
+
+def primary_warm_targets():
+    """The transcription and cleanup providers the router currently sends requests to first."""
+    endpoints = {
+        "Fireworks": (origin(FIREWORKS_ENDPOINT), http_client),
+        "Groq": (origin(str(groq_client.base_url)) if groq_client else None, http_client),
+        "Cerebras": (origin(CEREBRAS_ENDPOINT), http_client),
+        "OpenAI": (origin(OPENAI_ENDPOINT), http_client),
+    }
+    if LOCAL_ASR == "only":
+        return []
+    targets = []
+    sizes = (WARM_AUDIO_SECONDS, WARM_AUDIO_SECONDS * WORDS_PER_SECOND)
+    for providers, units in zip((ASR_PROVIDERS, LLM_PROVIDERS), sizes):
+        names = [provider[0] for provider in providers if provider[1]]
+        names = router.order(names, units, claim_probes=False)
+        if names:
+            targets.append((names[0], *endpoints[names[0]]))
+    return targets
+
+
+class Job:
+    """One dictation, with its own capture buffer and segmenter.
+
+    seq is the recording order, which the output sequencer preserves.
+    captured is set once the capture service has finished writing the buffer.
+    """
+
+    def __init__(self, seq, buffer, segmenter=None, trace=None):
+        self.seq = seq
+        self.buffer = buffer
+        self.segmenter = segmenter
+        self.trace = trace or Trace()
+        self.captured = threading.Event()
+        self.enqueued_at = None
+        self.released_at = None  # perf_counter() when the hotkey was released
+        self.captured_at = None
+        self.timings = {}  # Stage durations for this dictation
+
+
+class OutputSequencer:
+    """Writes each job's output in recording order, even when a later job finishes first.
+
+    Text emitted by the job at the head of the order is written immediately;
+    text from later jobs is held until every earlier job has been closed.
+    Held text is written in the context it was emitted in, so its timing
+    stages still belong to its own dictation.
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self._lock = threading.Lock()
+        self._next = 0
+        self._pending = collections.defaultdict(list)
+        self._closed = {}  # seq -> (done callback, context) of closed jobs not yet written out
+
+    def emit(self, seq, text):
+        with self._lock:
+            if seq == self._next:
+                self._write(text)
+            else:
+                self._pending[seq].append((text, contextvars.copy_context()))
+
+    def close(self, seq, done=None):
+        """Mark a job as done, successful or not, and release output waiting on it.
+
+        `done` is called once all of the job's text has been written, which
+        is later than now if an earlier job is still running.
+        """
+        with self._lock:
+            self._closed[seq] = (done, contextvars.copy_context())
+            while self._next in self._closed:
+                done, context = self._closed.pop(self._next)
+                if done is not None:
+                    context.run(done)
+                self._next += 1
+                for text, context in self._pending.pop(self._next, []):
+                    context.run(self._write, text)
+
+
+class PasteGate:
+    """Holds back the next clipboard change until the previous paste has been fetched.
+
+    expect() is called when sending Ctrl+V, fetched() once the target window
+    has read the clipboard, and wait() before replacing the clipboard. wait()
+    returns on fetched(), or `timeout` seconds after the paste when there is
+    no way to tell (xclip).
+    """
+
+    def __init__(self, timeout):
+        self._timeout = timeout
+        self._fetched = threading.Event()
+        self._fetched.set()
+        self._pasted_at = 0.0
+
+    def expect(self):
+        self._pasted_at = time.monotonic()
+        self._fetched.clear()
+
+    def fetched(self):
+        self._fetched.set()
+
+    def wait(self):
+        remaining = self._pasted_at + self._timeout - time.monotonic()
+        if remaining > 0 and not self._fetched.wait(remaining):
+            logger.debug("Previous paste was not fetched in time, replacing the clipboard anyway")
+
+
+class X11Output:
+    """Inserts text into the focused X11 window without spawning xclip/xdotool.
+
+    The CLIPBOARD selection is owned by an invisible window of our own and
+    served to other clients from a background thread. Ctrl+V (or, for short
+    text, the text itself) is sent with the XTest extension on a second
+    connection, after releasing any modifiers the user is still holding;
+    they are pressed again afterwards, like xdotool --clearmodifiers.
+    insert() is meant to be called from a single thread.
+    """
+
+    def __init__(self, type_max_chars):
+        self._type_max_chars = type_max_chars
+        self._display = xdisplay.Display()  # Selection owner; read by the event thread
+        self._input = xdisplay.Display()  # XTest injection and keyboard state
+        if not self._input.has_extension("XTEST"):
+            raise RuntimeError("XTEST extension not available")
+        self._window = self._display.screen().root.create_window(0, 0, 1, 1, 0, X.CopyFromParent)
+        self._atoms = {
+            name: self._display.intern_atom(name) for name in ("CLIPBOARD", "TARGETS", "UTF8_STRING", "TEXT")
+        }
+        self._max_bytes = self._display.display.info.max_request_length * 4 - 64
+        self._modifiers = [code for codes in self._input.get_modifier_mapping() for code in codes if code]
+        self._control = self._input.keysym_to_keycode(XK.XK_Control_L)
+        self._v = self._input.keysym_to_keycode(XK.XK_v)
+        self._shift = self._input.keysym_to_keycode(XK.XK_Shift_L)
+        self._lock = threading.Lock()
+        self._text = None
+        self._gate = PasteGate(PASTE_FETCH_TIMEOUT)
+        threading.Thread(target=self._serve_selection, name="x11-clipboard", daemon=True).start()
+
+    @classmethod
+    def connect(cls, type_max_chars):
+        """An X11Output, or None when python-xlib or an X server with XTest is not available."""
+        if xdisplay is None:
+            logger.info("python-xlib is not installed; using xclip and xdotool for output")
+            return None
+        try:
+            return cls(type_max_chars)
+        except Exception as e:
+            logger.warning(f"Could not connect to the X server ({e}); using xclip and xdotool for output")
+            return None
+
+    def insert(self, text):
+        """Put text on the clipboard and into the focused window. False if it has to go another way."""
+        data = text.encode("utf-8")
+        if len(data) > self._max_bytes:
+            return False  # Would need the INCR protocol
+        with stage("clipboard"):
+            self._gate.wait()
+            with self._lock:
+                self._text = data
+            self._window.set_selection_owner(self._atoms["CLIPBOARD"], X.CurrentTime)
+            self._display.sync()  # Own the clipboard before the target window sees Ctrl+V
+
+        with stage("paste"):
+            strokes = self._keystrokes(text) if len(text) <= self._type_max_chars else None
+            held = self._held_modifiers()
+            for keycode in held:
+                xtest.fake_input(self._input, X.KeyRelease, keycode)
+            if strokes is not None:
+                for keycode, shift in strokes:
+                    self._tap(keycode, self._shift if shift else None)
+            else:
+                self._gate.expect()  # Before Ctrl+V, which the window may answer right away
+                self._tap(self._v, self._control)
+            for keycode in held:
+                xtest.fake_input(self._input, X.KeyPress, keycode)
+            self._input.flush()
+        logger.debug(f"{'Typed' if strokes is not None else 'Pasted'} {len(text)} characters")
+        return True
+
+    def _tap(self, keycode, modifier=None):
+        if modifier:
+            xtest.fake_input(self._input, X.KeyPress, modifier)
+        xtest.fake_input(self._input, X.KeyPress, keycode)
+        xtest.fake_input(self._input, X.KeyRelease, keycode)
+        if modifier:
+            xtest.fake_input(self._input, X.KeyRelease, modifier)
+
+    def _held_modifiers(self):
+        keymap = self._input.query_keymap()
+        return [code for code in self._modifiers if keymap[code // 8] >> (code % 8) & 1]
+
+    def _keystrokes(self, text):
+        """(keycode, needs shift) for each character, or None if the text can't be typed reliably."""
+        if self._input.screen().root.query_pointer().mask & X.LockMask:
+            return None  # Caps Lock would flip the case
+        strokes = []
+        for char in text:
+            # Printable Latin-1 characters have keysyms equal to their code points.
+            if not (0x20 <= ord(char) <= 0x7E or 0xA0 <= ord(char) <= 0xFF):
+                return None
+            keysym = ord(char)
+            keycode = self._input.keysym_to_keycode(keysym)
+            if not keycode:
+                return None
+            if self._input.keycode_to_keysym(keycode, 0) == keysym:
+                strokes.append((keycode, False))
+            elif self._input.keycode_to_keysym(keycode, 1) == keysym:
+                strokes.append((keycode, True))
+            else:
+                return None
+        return strokes
+
+    def _serve_selection(self):
+        while True:
+            event = self._display.next_event()
+            if event.type == X.SelectionRequest:
+                self._answer(event)
+            elif event.type == X.SelectionClear:
+                with self._lock:
+                    self._text = None  # Another client owns the clipboard now
+
+    def _answer(self, request):
+        with self._lock:
+            data = self._text
+        prop = request.property if request.property != X.NONE else request.target
+        if data is None:
+            prop = X.NONE
+        elif request.target == self._atoms["TARGETS"]:
+            targets = [self._atoms["TARGETS"], self._atoms["UTF8_STRING"], self._atoms["TEXT"], Xatom.STRING]
+            request.requestor.change_property(prop, Xatom.ATOM, 32, targets)
+        elif request.target in (self._atoms["UTF8_STRING"], self._atoms["TEXT"]):
+            request.requestor.change_property(prop, self._atoms["UTF8_STRING"], 8, data)
+            self._gate.fetched()
+        elif request.target == Xatom.STRING:
+            latin1 = data.decode("utf-8").encode("latin-1", errors="replace")
+            request.requestor.change_property(prop, Xatom.STRING, 8, latin1)
+            self._gate.fetched()
+        else:
+            prop = X.NONE
+        notify = xevent.SelectionNotify(
+            time=request.time,
+            requestor=request.requestor,
+            selection=request.selection,
+            target=request.target,
+            property=prop,
+        )
+        request.requestor.send_event(notify)
+        self._display.flush()
+
+
+class ProcessingWorker:
+    """Runs dictation jobs from a bounded queue on dedicated worker threads.
+
+    Key handlers only enqueue jobs, so resampling, uploads, the LLM call and
+    pasting never block pynput's listener thread. Queue depth and job wait
+    times are kept for metrics().
+    """
+
+    def __init__(self, handler, maxsize, workers=1):
+        self._handler = handler
+        self._jobs = queue.Queue(maxsize)
+        self._wait_times = collections.deque(maxlen=100)
+        self.submitted = 0
+        self.dropped = 0
+        self.completed = 0
+        self._threads = [
+            threading.Thread(target=self._run, name=f"processing-{i}", daemon=True) for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, job):
+        """Queue a job without blocking. Returns False if the queue is full."""
+        job.enqueued_at = time.monotonic()
+        metrics.observe("voiceflow_queue_depth", self._jobs.qsize())
+        try:
+            self._jobs.put_nowait(job)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        return True
+
+    def metrics(self):
+        waits = list(self._wait_times)
+        return {
+            "queue_depth": self._jobs.qsize(),
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "completed": self.completed,
+            "wait_ms_last": waits[-1] * 1000 if waits else 0.0,
+            "wait_ms_avg": sum(waits) / len(waits) * 1000 if waits else 0.0,
+            "wait_ms_max": max(waits) * 1000 if waits else 0.0,
+        }
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            wait = time.monotonic() - job.enqueued_at
+            self._wait_times.append(wait)
+            logger.info(f"Processing job {job.seq} after {wait * 1000:.1f} ms in queue (depth {self._jobs.qsize()})")
+            try:
+                self._handler(job)
+            except Exception as e:
+                logger.error(f"Unhandled error in processing worker: {e}")
+            finally:
+                self.completed += 1
+
+
 # Global variables
 is_recording = False
 p = pyaudio.PyAudio()
-frames = []
+supported_rates = probe_input_rates(p)  # Probed once at startup
+capture_rate = negotiate_capture_rate(supported_rates)
+if RESAMPLER == "ffmpeg" and ffmpeg is None:
+    logger.warning("VOICEFLOW_RESAMPLER=ffmpeg but ffmpeg-python is not installed; resampling in-process")
+    RESAMPLER = "numpy"
+
+if LOCAL_ASR not in LOCAL_ASR_MODES:
+    logger.warning(f"Unknown VOICEFLOW_LOCAL_ASR={LOCAL_ASR!r}; local transcription is off")
+    LOCAL_ASR = "off"
+elif LOCAL_ASR != "off" and WhisperModel is None:
+    logger.warning("VOICEFLOW_LOCAL_ASR is set but faster-whisper is not installed; local transcription is off")
+    LOCAL_ASR = "off"
+local_transcriber = LocalTranscriber(LOCAL_ASR_MODEL, LOCAL_ASR_THREADS) if LOCAL_ASR != "off" else None
+
+if LOCAL_CLEANUP not in LOCAL_CLEANUP_MODES:
+    logger.warning(f"Unknown VOICEFLOW_LOCAL_CLEANUP={LOCAL_CLEANUP!r}; using auto")
+    LOCAL_CLEANUP = "auto"
+
+if capture_rate == TARGET_RATE:
+    logger.info(f"Capturing at {capture_rate} Hz")
+    buffer_rate, resampler = capture_rate, None
+elif RESAMPLER == "ffmpeg":
+    logger.info(f"Capturing at {capture_rate} Hz (resampling to {TARGET_RATE} Hz with ffmpeg after recording)")
+    buffer_rate, resampler = capture_rate, None
+else:
+    logger.info(f"Capturing at {capture_rate} Hz (resampling to {TARGET_RATE} Hz while recording)")
+    buffer_rate, resampler = TARGET_RATE, StreamingResampler(capture_rate, TARGET_RATE)
+
+# One buffer per dictation that is recording, queued or being processed
+capture_buffers = BufferPool(
+    JOB_QUEUE_SIZE + JOB_WORKERS + 1,
+    MAX_RECORD_SECONDS,
+    buffer_rate,
+    p.get_sample_size(FORMAT),
+    preallocate=2,
+)
+capture_service = CaptureService(
+    p,
+    buffer_rate,
+    device_rate=capture_rate,
+    resampler=resampler,
+    warm=WARM_STREAM,
+    preroll=PrerollBuffer(PREROLL_MS / 1000, buffer_rate, p.get_sample_size(FORMAT)),
+    idle_timeout=WARM_IDLE_SECONDS,
+)
+router = ProviderRouter(ROUTER_STATE_FILE)
+cleanup_cache = CleanupCache(CLEANUP_CACHE_SIZE, CLEANUP_CACHE_FILE) if CLEANUP_CACHE_SIZE > 0 else None
+trace_writer = TraceWriter(TRACE_FILE) if TRACE_FILE else None
+connection_warmer = ConnectionWarmer(pipeline_loop, primary_warm_targets, HTTP_WARM_INTERVAL)
+
+
+def render_metrics():
+    """Copy the counters kept elsewhere into `metrics` and render them."""
+    worker = processing_worker.metrics()
+    metrics.set("voiceflow_queue_jobs", worker["queue_depth"])
+    for state in ("submitted", "dropped", "completed"):
+        metrics.set("voiceflow_jobs", worker[state], state=state)
+    for stat in ("last", "avg", "max"):
+        metrics.set("voiceflow_queue_wait_seconds", worker[f"wait_ms_{stat}"] / 1000, stat=stat)
+    for event, count in hedge_stats.items():
+        metrics.set("voiceflow_hedges", count, event=event)
+    if cleanup_cache is not None:
+        cache = cleanup_cache.stats()
+        metrics.set("voiceflow_cleanup_cache_lookups", cache["hits"], result="hit")
+        metrics.set("voiceflow_cleanup_cache_lookups", cache["misses"], result="miss")
+    metrics.set("voiceflow_local_cleanups", cleanup_stats["local"])
+    for name, summary in router.summary().items():
+        metrics.set("voiceflow_circuit_open", int(summary["state"] == "open"), provider=name)
+    return metrics.render()
+
+
+job_sequence = itertools.count()
+current_job = None
 alt_pressed = False
 
 
 def on_press(key):
-    global is_recording, frames, alt_pressed
+    global is_recording, alt_pressed, current_job
     try:
         if key == keyboard.Key.alt:
             alt_pressed = True
+            capture_service.warm_up()
+            connection_warmer.warm()
         elif key.char == "t" and alt_pressed and not is_recording:
+            buffer = capture_buffers.acquire()
+            if buffer is None:
+                logger.warning("Too many dictations in progress. Ignoring Alt+T.")
+                return
+            trace = Trace()
+            segmenter = Segmenter(pipeline_loop, trace) if SEGMENTED_TRANSCRIPTION else None
+            current_job = Job(next(job_sequence), buffer, segmenter, trace)
             is_recording = True
-            frames = []
-            threading.Thread(target=record_audio).start()
-            logger.info("Recording started")
+            capture_service.start_recording(current_job)
     except AttributeError:
         pass
 
 
 def on_release(key):
-    global is_recording, alt_pressed
+    global is_recording, alt_pressed, current_job
     try:
         if key == keyboard.Key.alt:
             alt_pressed = False
         if (key == keyboard.Key.alt or key.char == "t") and is_recording:
             is_recording = False
-            logger.info("Recording stopped")
-            process_audio()
+            current_job.released_at = time.perf_counter()
+            capture_service.stop_recording()
+            job, current_job = current_job, None
+            if processing_worker.submit(job):
+                logger.info("Recording stopped")
+            else:
+                logger.error("Processing queue is full. Dropping recording.")
+                metrics.inc("voiceflow_dictations", outcome="dropped")
+                output_executor.submit(drop_job, job)
     except AttributeError:
         pass
 
 
-def record_audio():
-    global is_recording, frames
+def drop_job(job):
+    """Discard a dictation the processing queue had no room for; runs on the output thread like all output."""
+    job.captured.wait()  # The capture thread may still be writing to the buffer and submitting segments
+    if job.segmenter is not None:
+        job.segmenter.cancel()
+    capture_buffers.release(job.buffer)
+    output_sequencer.close(job.seq, functools.partial(finish_job_timing, job, "dropped"))
+
+
+def detect_speech(samples, rate):
+    """Classify VAD_FRAME_MS frames of int16 audio as speech or silence.
+
+    A frame is speech when it is louder than VAD_SPEECH_DBFS, when its energy
+    is well above the recording's noise floor, or slightly less loud but with
+    a high zero-crossing rate (unvoiced consonants such as "s" and "f").
+    Returns the boolean mask and frame length.
+    """
+    frame_len = rate * VAD_FRAME_MS // 1000
+    count = len(samples) // frame_len
+    if count == 0:
+        return np.zeros(0, dtype=bool), frame_len
+    frames = samples[: count * frame_len].reshape(count, frame_len).astype(np.float32) / 32768.0
+
+    energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+    zero_crossings = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+
+    # Even continuous speech dips between syllables, so the quietest frames
+    # approximate the background level. A clip without any real pause has no
+    # such frames, so the estimate is capped at a plausible background level.
+    noise_floor = min(np.percentile(energy_db, 10), VAD_NOISE_CEILING_DBFS)
+    threshold = max(VAD_FLOOR_DBFS, noise_floor + 10)
+    voiced = (energy_db > threshold) | (energy_db > VAD_SPEECH_DBFS)
+    unvoiced = (energy_db > max(VAD_FLOOR_DBFS, threshold - 6)) & (zero_crossings > 0.3)
+    return voiced | unvoiced, frame_len
+
+
+def trim_silence(samples, rate):
+    """Trim silence around speech and shorten long pauses.
+
+    Returns the trimmed int16 samples, or None when the clip has no speech.
+    A clip with too little speech to trim around is only dropped when none of
+    it is louder than VAD_SPEECH_DBFS; otherwise it is returned untrimmed, so
+    the transcription provider decides.
+    """
+    speech, frame_len = detect_speech(samples, rate)
+    if np.count_nonzero(speech) * VAD_FRAME_MS < VAD_MIN_SPEECH_MS:
+        peak = np.max(np.abs(samples.astype(np.int32)), initial=0)
+        if peak < 32768 * 10 ** (VAD_SPEECH_DBFS / 20):
+            return None
+        logger.info("Too little speech detected to trim around; uploading the recording as is")
+        return samples
+
+    # Keep some padding around speech so word onsets and endings are not clipped.
+    pad = VAD_PADDING_MS // VAD_FRAME_MS
+    keep = np.convolve(speech, np.ones(2 * pad + 1), mode="same") > 0
+    kept = np.flatnonzero(keep)
+    first, last = kept[0], kept[-1] + 1
+    keep = keep[first:last]
+
+    # Internal pauses are kept up to VAD_MAX_PAUSE_MS; the middle of longer ones is dropped.
+    max_pause = VAD_MAX_PAUSE_MS // VAD_FRAME_MS
+    edges = np.diff(np.concatenate(([1], keep.astype(np.int8), [1])))
+    for start, end in zip(np.flatnonzero(edges == -1), np.flatnonzero(edges == 1)):
+        if end - start > max_pause:
+            keep[start : start + max_pause // 2] = True
+            keep[end - (max_pause - max_pause // 2) : end] = True
+        else:
+            keep[start:end] = True
+
+    frames = samples[first * frame_len : last * frame_len].reshape(-1, frame_len)
+    return frames[keep].ravel()
+
+
+def build_wav(pcm, rate):
+    """Wrap 16-bit mono PCM in a WAV container entirely in memory."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wf:
+        wf.setnchannels(CHANNELS)
+        wf.setsampwidth(p.get_sample_size(FORMAT))
+        wf.setframerate(rate)
+        wf.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def resample_with_ffmpeg(pcm, rate):
+    """Downsample raw PCM to TARGET_RATE through ffmpeg pipes, without temp files."""
+    logger.info("Starting audio preprocessing with ffmpeg")
     try:
-        stream = p.open(
-            format=FORMAT,
-            channels=CHANNELS,
-            rate=RATE,
-            input=True,
-            frames_per_buffer=CHUNK,
+        out, _ = (
+            ffmpeg.input("pipe:", format="s16le", ar=rate, ac=CHANNELS)
+            .output("pipe:", format="s16le", ar=TARGET_RATE, ac=1, acodec="pcm_s16le")
+            .run(input=bytes(pcm), capture_stdout=True, capture_stderr=True)
         )
-        logger.info("Recording started")
+    except ffmpeg.Error as e:
+        logger.error(f"Error during audio preprocessing: {e.stderr.decode()}")
+        raise
+    logger.info("Audio preprocessing completed")
+    return out
+
+
+async def transcribe_pcm_async(pcm, rate, deadline=None):
+    """Trim, resample and transcribe a block of int16 samples.
+
+    Returns the transcript, an empty string when the audio has no speech, or
+    None when transcription failed. The CPU-bound steps run in a worker thread
+    so they don't hold up the event loop.
+    """
+    if VAD_ENABLED:
+        with stage("vad"):
+            pcm = await asyncio.to_thread(trim_silence, pcm, rate)
+        if pcm is None:
+            return ""
+        logger.info(f"Speech length after trimming silence: {len(pcm) / rate:.2f} seconds")
+
+    if rate != TARGET_RATE:
+        # Preprocess audio (downsample to 16kHz)
+        with stage("resample"):
+            pcm = np.frombuffer(await asyncio.to_thread(resample_with_ffmpeg, pcm, rate), dtype=np.int16)
 
-        start_time = time.time()
-        while is_recording and (time.time() - start_time) < MAX_RECORD_SECONDS:
-            data = stream.read(CHUNK)
-            frames.append(data)
-            if (time.time() - start_time) % 1 < 0.1:  # Log every second
-                logger.info("Recording in progress: {:.1f} seconds".format(time.time() - start_time))
+    return await transcribe_audio_async(pcm, deadline)
 
-        logger.info(
-            "Recording finished. Duration: {:.1f} seconds. Frames: {}".format(time.time() - start_time, len(frames))
-        )
-        stream.stop_stream()
-        stream.close()
-    except Exception as e:
-        logger.error(f"Error during audio recording: {e}")
-        is_recording = False
+
+def transcribe_pcm(pcm, rate, deadline=None):
+    return pipeline_loop.run(transcribe_pcm_async(pcm, rate, deadline))
+
+
+def process_audio(job):
+    """Run one dictation through the pipeline; called on a processing worker thread."""
+    pipeline_loop.run(process_job(job))
 
 
-def process_audio():
-    global frames
-    logger.info("Starting audio processing")
+async def process_job(job):
+    """Capture handoff, ASR and cleanup for one dictation; the text goes to the output thread."""
+    started = time.perf_counter()
+    await asyncio.to_thread(job.captured.wait)
+    logger.info(f"Starting audio processing for recording {job.seq} (trace {job.trace.trace_id})")
+    job_timings.set(job.timings)
+    job_trace.set(job.trace)
+    if job.released_at is not None:
+        job.trace.record("queue", job.released_at, started)
+    if job.captured_at is not None:
+        capture = job.trace.record("capture", job.trace.started_at, job.captured_at, seconds=job.buffer.seconds)
+        if job.released_at is not None:
+            latency_stats.record("capture_stop", max(0.0, job.captured_at - job.released_at))
+            job.trace.record("capture_stop", job.released_at, job.captured_at, parent=capture)
+    # Output runs on the output thread, but its stages still belong to this dictation.
+    context = contextvars.copy_context()
 
+    buffer = job.buffer
+    outcome = "failed"
     try:
-        # Save the recorded audio to a temporary file
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
-            temp_file_name = temp_file.name
-            logger.info(f"Temporary file created: {temp_file_name}")
-
-            wf = wave.open(temp_file_name, "wb")
-            wf.setnchannels(CHANNELS)
-            wf.setsampwidth(p.get_sample_size(FORMAT))
-            wf.setframerate(RATE)
-            wf.writeframes(b"".join(frames))
-            wf.close()
-
-            file_size = os.path.getsize(temp_file_name)
-            logger.info(f"Audio data written to temporary file. Size: {file_size} bytes")
-
-        # Check if the recording is at least 1 second long
-        if len(frames) < RATE / CHUNK:
+        logger.info(f"Recording length: {buffer.seconds:.2f} seconds")
+        metrics.observe("voiceflow_audio_seconds", buffer.seconds)
+        pcm = np.frombuffer(buffer.view(), dtype=np.int16)
+
+        # Check if the recording is at least 1 second long (VAD applies its own minimum)
+        if not VAD_ENABLED and buffer.frames < buffer.rate:
             logger.info("Recording too short (less than 1 second). Discarding.")
+            outcome = "no_speech"
             return
 
-        logger.info(f"Recording length: {len(frames) * CHUNK / RATE:.2f} seconds")
-
-        # Preprocess audio (downsample to 16kHz)
-        try:
-            logger.info("Starting audio preprocessing with ffmpeg")
-            stream = ffmpeg.input(temp_file_name)
-            stream = ffmpeg.output(
-                stream,
-                PROCESSED_OUTPUT_FILENAME,
-                ar=16000,
-                ac=1,
-                acodec="pcm_s16le",
-            )
-            ffmpeg.run(stream, capture_stdout=True, capture_stderr=True)
-            logger.info(f"Audio preprocessing completed. Output: {PROCESSED_OUTPUT_FILENAME}")
-        except ffmpeg.Error as e:
-            logger.error(f"Error during audio preprocessing: {e.stderr.decode()}")
-            raise
-
-        # Transcribe audio
-        transcription = transcribe_audio(PROCESSED_OUTPUT_FILENAME)
+        # Transcribe audio; transcription and cleanup share one latency budget
+        deadline = dictation_deadline(buffer.seconds)
+        with span("transcribe", budget=round(deadline.budget, 3)):
+            if job.segmenter is not None:
+                transcription = await job.segmenter.finish(pcm, buffer.rate, deadline)
+            else:
+                transcription = await transcribe_pcm_async(pcm, buffer.rate, deadline)
+        if transcription == "":
+            logger.info("No speech detected. Discarding.")
+            outcome = "no_speech"
+            return
         if not transcription:
             logger.error("Transcription failed")
             raise Exception("Transcription failed")
 
-        logger.info(f"Transcription result: {transcription}")
-        print(f"Transcription: {transcription}")  # Console output
-
-        # Process transcription with AI
-        processed_text = process_transcription(transcription)
+        logger.info(f"Transcription: {len(transcription.split())} words")
+        logger.debug("Transcription result: %s", transcription)
 
-        # Output processed text
-        pyperclip.copy(processed_text)
-        insert_text_into_active_window(processed_text)
-        logger.info("Text copied to clipboard and inserted into active window")
+        # Process transcription with AI; output is written once every earlier dictation has been
+        output = functools.partial(output_executor.submit, context.run, output_sequencer.emit, job.seq)
+        with span("cleanup"):
+            processed_text = await process_transcription_async(transcription, deadline, output)
+        if processed_text == "":
+            logger.info("Transcript was only filler words. Discarding.")
+            outcome = "no_speech"
+            return
+        if not processed_text:
+            raise Exception("Transcription processing failed")
+        logger.info(f"Dictation {job.seq} processed in {deadline.elapsed():.2f}s (budget {deadline.budget:.2f}s)")
+        outcome = "ok"
 
     except Exception as e:
         logger.error(f"Error during audio processing: {e}")
     finally:
-        # Clean up temporary files
+        metrics.inc("voiceflow_dictations", outcome=outcome)
+        capture_buffers.release(buffer)
+        done = functools.partial(finish_job_timing, job, outcome)
+        output_executor.submit(context.run, output_sequencer.close, job.seq, done)
+
+
+def finish_job_timing(job, outcome):
+    """Record the end-to-end time from hotkey release to output, log the stage breakdown and write the trace.
+
+    Called once the dictation's text has been written, after any earlier dictation it was waiting for.
+    """
+    end = time.perf_counter()
+    if job.released_at is not None:
+        latency_stats.record("total", end - job.released_at)
+    breakdown = ", ".join(f"{label} {seconds * 1000:.0f} ms" for label, seconds in job.timings.items())
+    logger.info(f"Dictation {job.seq} ({job.trace.trace_id}) timings: {breakdown}")
+    job.trace.finish(end, seq=job.seq, outcome=outcome)
+    if trace_writer is not None:
+        trace_writer.write(job.seq, job.trace)
+
+
+def output_text(text):
+    with span("output", characters=len(text)):
+        if x11_output is not None and x11_output.insert(text):
+            logger.info("Text copied to clipboard and inserted into active window")
+            return
+        insert_text_into_active_window(text)
+
+
+processing_worker = ProcessingWorker(process_audio, JOB_QUEUE_SIZE, workers=JOB_WORKERS)
+output_sequencer = OutputSequencer(output_text)
+x11_output = X11Output.connect(TYPE_MAX_CHARS)
+xclip_paste_gate = PasteGate(PASTE_FETCH_TIMEOUT)  # xclip can't tell when the paste was fetched
+# Output is written on its own thread, in submission order; the xclip/xdotool fallback blocks.
+output_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="output")
+
+
+def encode_audio(pcm, fmt):
+    """Encode 16 kHz int16 samples for upload. Returns (data, format actually used)."""
+    if fmt not in UPLOAD_FORMATS or (fmt != "wav" and soundfile is None):
+        logger.warning(f"Upload format {fmt!r} is not available, using WAV")
+        fmt = "wav"
+    if fmt == "wav":
+        return build_wav(pcm, TARGET_RATE), fmt
+
+    buffer = io.BytesIO()
+    try:
+        if fmt == "flac":
+            soundfile.write(buffer, pcm, TARGET_RATE, format="FLAC", subtype="PCM_16")
+        else:
+            soundfile.write(
+                buffer,
+                pcm,
+                TARGET_RATE,
+                format="OGG",
+                subtype="OPUS",
+                compression_level=OPUS_COMPRESSION_LEVEL,
+            )
+    except Exception as e:
+        logger.error(f"{fmt.upper()} encoding failed, using WAV: {e}")
+        return build_wav(pcm, TARGET_RATE), "wav"
+    return buffer.getvalue(), fmt
+
+
+rejected_upload_formats = set()  # (provider, format) pairs a provider has refused
+
+
+def prepare_upload(provider, pcm, fmt, encoded):
+    """Return the multipart file tuple for a provider, encoding each format once per request."""
+    if (provider, fmt) in rejected_upload_formats:
+        fmt = "wav"
+    if fmt not in encoded:
+        encoded[fmt] = encode_audio(pcm, fmt)
+    data, fmt = encoded[fmt]
+    metrics.observe("voiceflow_upload_bytes", len(data), provider=provider, format=fmt)
+
+    wav_size = WAV_HEADER_BYTES + pcm.nbytes
+    logger.info(
+        f"{provider} upload: {fmt.upper()} {len(data)} bytes "
+        f"({wav_size - len(data)} bytes / {100 * (1 - len(data) / wav_size):.0f}% saved vs WAV)"
+    )
+    filename, mime_type = UPLOAD_FORMATS[fmt]
+    return (filename, data, mime_type), fmt
+
+
+def is_format_rejection(error, fmt):
+    """True when a provider refused a compressed upload, so WAV is worth a retry."""
+    if fmt == "wav":
+        return False
+    status = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    return status in (400, 415)
+
+
+async def transcribe_with_fireworks(upload, timeout):
+    headers = {"Authorization": f"Bearer {FIREWORKS_API_KEY}"}
+    data = {"model": "whisper-v3", "response_format": "text"}
+
+    logger.debug("Sending request to Fireworks API...")
+    response = await http_client.post(
+        FIREWORKS_ENDPOINT,
+        headers=headers,
+        files={"file": upload},
+        data=data,
+        timeout=timeout,
+    )
+    response.raise_for_status()
+
+    logger.debug("Fireworks API response: %s", response.text)
+    return response.text.strip()
+
+
+async def transcribe_with_groq(upload, timeout):
+    logger.debug("Sending request to Groq API...")
+    transcription = await groq_client.audio.transcriptions.create(
+        file=upload,
+        model="whisper-large-v3",
+        response_format="text",
+        language="en",
+        temperature=0.0,
+        timeout=timeout,
+    )
+
+    logger.debug("Groq API response: %s", transcription)
+    return transcription.text.strip()
+
+
+async def transcribe_with_local(samples, timeout):
+    """Transcribe 16 kHz int16 samples with the resident local model.
+
+    `timeout` is not enforced: the inference can't be interrupted, and when
+    the network is down this is the last resort anyway.
+    """
+    logger.debug(f"Transcribing locally with {local_transcriber.model}...")
+    return await asyncio.to_thread(local_transcriber.transcribe, samples)
+
+
+# Transcription providers in fallback order: (name, API key, upload format, function)
+ASR_PROVIDERS = (
+    ("Fireworks", FIREWORKS_API_KEY, FIREWORKS_UPLOAD_FORMAT, transcribe_with_fireworks),
+    ("Groq", GROQ_API_KEY, GROQ_UPLOAD_FORMAT, transcribe_with_groq),
+)
+LOCAL_PROVIDER = ("Local", None, transcribe_with_local)  # No upload format: takes the samples as they are
+
+
+def asr_providers(seconds, claim_probes=True):
+    """(name, upload format, function) for each provider to try on `seconds` of audio, in order.
+
+    Network providers are ordered by the router; the local model goes first
+    or last depending on VOICEFLOW_LOCAL_ASR.
+    """
+    if LOCAL_ASR == "only":
+        return [LOCAL_PROVIDER]
+    configured = {name: (name, fmt, transcribe) for name, api_key, fmt, transcribe in ASR_PROVIDERS if api_key}
+    providers = [configured[name] for name in router.order(list(configured), seconds, claim_probes)]
+    if LOCAL_ASR == "short" and seconds <= LOCAL_ASR_SHORT_SECONDS:
+        return [LOCAL_PROVIDER] + providers
+    if LOCAL_ASR != "off":
+        providers.append(LOCAL_PROVIDER)
+    return providers
+
+
+hedge_stats = {"requests": 0, "hedged": 0, "secondary_wins": 0}
+
+
+def dictation_deadline(audio_seconds):
+    """Budget for transcribing and cleaning up `audio_seconds` of speech.
+
+    The expected work uses the fastest healthy provider's latency model
+    (overhead plus time per second of audio or per word) for transcription
+    and for LLM cleanup.
+    """
+    asr_names = [name for name, _, _ in asr_providers(audio_seconds, claim_probes=False)]
+    llm_names = [name for name, api_key, _, _ in LLM_PROVIDERS if api_key]
+    words = audio_seconds * WORDS_PER_SECOND
+    asr_expected = router.best_expected_latency(asr_names, audio_seconds) or audio_seconds * DEFAULT_ASR_RTF
+    llm_expected = router.best_expected_latency(llm_names, words) or words * DEFAULT_LLM_SECONDS_PER_WORD
+    return Deadline(DEADLINE_BASE + DEADLINE_SLACK * (asr_expected + llm_expected))
+
+
+def attempt_timeout(name, units, deadline, fallbacks):
+    timeout = deadline.timeout(router.stats(name).expected_latency(units), fallbacks)
+    logger.debug(f"{name} timeout {timeout:.1f}s ({deadline.remaining():.1f}s of {deadline.budget:.1f}s budget left)")
+    return timeout
+
+
+async def attempt_transcription(name, fmt, transcribe, pcm, encoded, deadline, fallbacks=0):
+    """Transcribe with one provider, retrying as WAV if it rejects a compressed upload.
+
+    A provider without an upload format (the local model) gets the samples themselves.
+    """
+    seconds = len(pcm) / TARGET_RATE
+    while True:
+        if fmt is None:
+            upload = pcm
+        else:
+            with stage("encode", name):
+                upload, fmt = await asyncio.to_thread(prepare_upload, name, pcm, fmt, encoded)
+        timeout = attempt_timeout(name, seconds, deadline, fallbacks)
+        start = time.monotonic()
         try:
-            os.unlink(temp_file_name)
-            os.unlink(PROCESSED_OUTPUT_FILENAME)
-            logger.info("Temporary files cleaned up")
+            with stage("asr", name, format=fmt, timeout=round(timeout, 3)):
+                text = await transcribe(upload, timeout)
         except Exception as e:
-            logger.error(f"Error cleaning up temporary files: {e}")
+            if fmt is not None and is_format_rejection(e, fmt):
+                logger.warning(f"{name} API rejected {fmt.upper()} upload, retrying with WAV: {e}")
+                rejected_upload_formats.add((name, fmt))
+                fmt = "wav"
+                continue
+            router.record_failure(name)
+            raise
+        router.record_success(name, time.monotonic() - start, seconds)
+        return text
 
 
-def transcribe_audio(audio_file):
-    """Transcribe the audio file using Fireworks API or Groq API as fallback."""
-    if not os.path.exists(audio_file):
-        logger.error(f"Audio file does not exist: {audio_file}")
-        return None
+def log_provider_error(name, error):
+    logger.error(f"{name} API request failed: {str(error)}")
+    response = getattr(error, "response", None)
+    if response is not None:
+        logger.error(f"{name} API error response: {getattr(response, 'text', response)}")
 
-    # Try Fireworks API first
-    if FIREWORKS_API_KEY:
-        try:
-            logger.info("Attempting Fireworks API transcription...")
-
-            with open(audio_file, "rb") as f:
-                files = {"file": (os.path.basename(audio_file), f, "audio/wav")}
-                headers = {"Authorization": f"Bearer {FIREWORKS_API_KEY}"}
-                data = {"model": "whisper-v3", "response_format": "text"}
-
-                logger.debug("Sending request to Fireworks API...")
-                response = requests.post(
-                    FIREWORKS_ENDPOINT,
-                    headers=headers,
-                    files=files,
-                    data=data,
-                    timeout=30,
-                )
-                response.raise_for_status()
 
-            logger.debug(f"Fireworks API response: {response.text}")
-            return response.text.strip()
+def hedge_delay(name, seconds):
+    """How long to wait for a provider before hedging `seconds` of audio.
 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Fireworks API request failed: {str(e)}")
-            if hasattr(e, "response"):
-                logger.error(f"Fireworks API error response: {e.response.text}")
+    Its expected latency for a clip this long, times a percentile of how much
+    slower than expected its recent requests were, so long dictations are not
+    hedged just for being long, nor short ones for the fixed overhead.
+    """
+    stats = router.stats(name)
+    if len(stats.samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return stats.expected_latency(seconds) * stats.slowdown_percentile(HEDGE_PERCENTILE)
 
-    # Fallback to Groq API
-    if GROQ_API_KEY:
-        try:
-            logger.info("Attempting Groq API transcription (fallback)...")
-            client = Groq(api_key=GROQ_API_KEY)
-
-            # Create a tuple with filename and file object as required by Groq
-            with open(audio_file, "rb") as audio:
-                file_tuple = (os.path.basename(audio_file), audio, "audio/wav")
-
-                logger.debug("Sending request to Groq API...")
-                transcription = client.audio.transcriptions.create(
-                    file=file_tuple,
-                    model="whisper-large-v3",
-                    response_format="text",
-                    language="en",
-                    temperature=0.0,
-                )
 
-            logger.debug(f"Groq API response: {transcription}")
-            return transcription.text.strip()
+async def transcribe_hedged(primary, secondary, pcm, encoded, deadline, fallbacks=0):
+    """Send to the primary and, if it is slower than usual, also to the secondary.
+
+    The first successful transcript wins and the other request is cancelled,
+    closing its connection. If the primary fails outright the secondary is
+    used as a plain fallback.
+    """
+    hedge_stats["requests"] += 1
+    names = {}
+
+    def launch(provider, fallbacks):
+        logger.info(f"Attempting {provider[0]} API transcription...")
+        task = asyncio.create_task(attempt_transcription(*provider, pcm, encoded, deadline, fallbacks))
+        names[task] = provider[0]
+        return task
+
+    pending = {launch(primary, fallbacks + 1)}
+    try:
+        delay = min(hedge_delay(primary[0], len(pcm) / TARGET_RATE), deadline.remaining())
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            hedge_stats["hedged"] += 1
+            logger.info(
+                f"{primary[0]} has not answered after {delay:.2f}s, hedging with {secondary[0]} "
+                f"(hedge rate {hedge_stats['hedged'] / hedge_stats['requests']:.0%})"
+            )
+            pending.add(launch(secondary, fallbacks))
+
+        secondary_launched = len(pending) > 1
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    text = task.result()
+                except Exception as e:
+                    log_provider_error(names[task], e)
+                    if not secondary_launched:
+                        secondary_launched = True
+                        metrics.inc("voiceflow_fallbacks", kind="asr")
+                        pending.add(launch(secondary, fallbacks))
+                    continue
+                for loser in pending:
+                    logger.info(f"{names[task]} answered first, cancelling {names[loser]} request")
+                if names[task] == secondary[0]:
+                    hedge_stats["secondary_wins"] += 1
+                return text
+        return None
+    finally:
+        # Also reached when the caller is cancelled: nothing keeps running in the background.
+        for task in pending:
+            task.cancel()
+
 
+async def transcribe_audio_async(pcm, deadline=None):
+    """Transcribe 16 kHz int16 samples with the fastest healthy provider, falling back to the others.
+
+    Attempts share `deadline` (by default a fresh budget for this audio).
+    """
+    if pcm is None or len(pcm) == 0:
+        logger.error("No audio data to transcribe")
+        return None
+    if deadline is None:
+        deadline = dictation_deadline(len(pcm) / TARGET_RATE)
+
+    encoded = {}
+    providers = asr_providers(len(pcm) / TARGET_RATE)
+    hedged = False
+    # Only network requests are hedged; the local model is not worth tying up the CPU for a race.
+    if HEDGE_ASR and len(providers) > 1 and LOCAL_PROVIDER not in providers[:2]:
+        text = await transcribe_hedged(providers[0], providers[1], pcm, encoded, deadline, len(providers) - 2)
+        if text is not None:
+            return text
+        hedged = True
+        providers = providers[2:]
+
+    for index, (name, fmt, transcribe) in enumerate(providers):
+        logger.info(f"Attempting {name} API transcription...")
+        if index > 0 or hedged:
+            metrics.inc("voiceflow_fallbacks", kind="asr")
+        fallbacks = len(providers) - index - 1
+        try:
+            return await attempt_transcription(name, fmt, transcribe, pcm, encoded, deadline, fallbacks)
         except Exception as e:
-            logger.error(f"Groq API request failed: {str(e)}")
-            if hasattr(e, "response"):
-                logger.error(f"Groq API error response: {e.response}")
+            log_provider_error(name, e)
 
     logger.error("All transcription attempts failed")
     return None
 
 
-def process_transcription(transcription):
-    """Process the transcription using Cerebras API or OpenAI API as fallback."""
-    prompt = (
-        "For the given transcription with unclear and incorrect grammar, spelling and "
-        "capitalization, return a cleaned text that is the exact representation of "
-        "the transcript but in a written form with correct grammar, spelling, "
-        "capitalization, etc. Do not add any additional text or comments. Do not "
-        "give me multiple options. ONLY output the cleaned text. "
-        f"<TRANSCRIPT>{transcription}</TRANSCRIPT>"
+def transcribe_audio(pcm, deadline=None):
+    return pipeline_loop.run(transcribe_audio_async(pcm, deadline))
+
+
+class SentenceStream:
+    """Collects streamed LLM output and writes out each sentence as soon as it is complete."""
+
+    BOUNDARY = re.compile(r"[.!?]\s+")
+
+    def __init__(self, write):
+        self._write = write
+        self._pending = ""
+        self._started = time.monotonic()
+        self._written = False
+        self.text = ""
+
+    def feed(self, delta):
+        self.text += delta
+        self._pending += delta
+        end = 0
+        for match in self.BOUNDARY.finditer(self._pending):
+            end = match.end()
+        if end:
+            if not self._written:
+                self._written = True
+                logger.info(f"First sentence of cleanup ready after {time.monotonic() - self._started:.2f}s")
+            self._write(self._pending[:end])
+            self._pending = self._pending[end:]
+
+    def close(self, suffix=""):
+        """Write the unfinished last sentence, followed by `suffix`."""
+        if self._pending or suffix:
+            self._write(self._pending + suffix)
+        self._pending = ""
+
+
+async def chat_completion(url, headers, payload, timeout, on_delta=None):
+    """POST a chat completion and return its text; with on_delta, stream it as server-sent events."""
+    if on_delta is None:
+        response = await http_client.post(url, headers=headers, json=payload, timeout=timeout)
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    parts = []
+    payload = {**payload, "stream": True}
+    async with http_client.stream("POST", url, headers=headers, json=payload, timeout=timeout) as response:
+        if response.is_error:
+            await response.aread()  # So the error body can be logged
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:") :].strip()
+            if data == "[DONE]":
+                break
+            delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+    return "".join(parts)
+
+
+async def clean_with_cerebras(prompt, timeout, on_delta=None):
+    return await chat_completion(
+        CEREBRAS_ENDPOINT,
+        {
+            "Authorization": f"Bearer {CEREBRAS_API_KEY}",
+            "Content-Type": "application/json",
+        },
+        {
+            "model": CEREBRAS_MODEL,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": ("You are a helpful assistant that improves transcriptions."),
+                },
+                {"role": "user", "content": prompt},
+            ],
+            "temperature": 0,
+            "max_completion_tokens": -1,
+            "stream": False,
+        },
+        timeout,
+        on_delta,
+    )
+
+
+async def clean_with_openai(prompt, timeout, on_delta=None):
+    return await chat_completion(
+        OPENAI_ENDPOINT,
+        {"Authorization": f"Bearer {OPENAI_API_KEY}"},
+        {
+            "model": OPENAI_MODEL,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": ("You are a helpful assistant that improves transcriptions."),
+                },
+                {"role": "user", "content": prompt},
+            ],
+        },
+        timeout,
+        on_delta,
     )
 
-    logger.info("Prompt for LLM: %s", prompt)
-    print(f"Prompt for LLM: {prompt}")  # Console output
 
-    # Try Cerebras API first
+def load_replacements(path):
+    """Compile the custom replacement dictionary into (pattern, mapping), or None if there is none."""
     try:
-        response = requests.post(
-            CEREBRAS_ENDPOINT,
-            headers={
-                "Authorization": f"Bearer {CEREBRAS_API_KEY}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": "llama3.1-8b",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": ("You are a helpful assistant that improves transcriptions."),
-                    },
-                    {"role": "user", "content": prompt},
-                ],
-                "temperature": 0,
-                "max_completion_tokens": -1,
-                "stream": False,
-            },
-            timeout=30,
-        )
-        response.raise_for_status()
-        processed_text = response.json()["choices"][0]["message"]["content"]
-    except requests.RequestException as e:
-        logger.error("Cerebras API error: %s", e)
-        # Fallback to OpenAI API
+        with open(path) as f:
+            replacements = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not load replacements from {path}: {e}")
+        return None
+    if not replacements:
+        return None
+    mapping = {phrase.casefold(): replacement for phrase, replacement in replacements.items()}
+    # Longest phrases first, so "voice flow app" wins over "voice flow"
+    alternatives = "|".join(re.escape(phrase) for phrase in sorted(mapping, key=len, reverse=True))
+    logger.info(f"Loaded {len(mapping)} replacements from {path}")
+    return re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)", re.IGNORECASE), mapping
+
+
+replacements = load_replacements(REPLACEMENTS_FILE)
+cleanup_stats = {"transcripts": 0, "local": 0}
+
+# Standalone fillers only: not "mm" (millimetres) and not parts of hyphenated words ("uh-huh", "mm-wave").
+FILLER_WORDS = re.compile(r"(?<![\w-])(?:u+[hm]+|e+rm|h+m+|m+h+m+|m{3,})(?![\w-])[,.…]*", re.IGNORECASE)
+SENTENCE_START = re.compile(r"(^|[.!?]\s+)([a-z])")
+# A period ending one of these does not end the sentence ("3 p.m. tomorrow", "e.g. this").
+ABBREVIATION = re.compile(r"(?:(?<![\w.])(?:[a-z]\.){2,}|\b(?:mr|mrs|ms|dr|prof|st|vs)\.)$", re.IGNORECASE)
+
+
+def capitalize_sentence(match):
+    if match.group(1) and ABBREVIATION.search(match.string, 0, match.start() + 1):
+        return match.group(0)
+    return match.group(1) + match.group(2).upper()
+
+
+def normalize_transcript(text):
+    """Rule-based cleanup: whitespace, filler words, replacements, sentence casing and terminal punctuation."""
+    text = FILLER_WORDS.sub("", text)
+    text = " ".join(text.split())
+    text = re.sub(r"\s+([,.!?;:])", r"\1", text)  # No space before punctuation
+    text = re.sub(r",(?:\s*,)+", ",", text)  # Commas left around a removed filler
+    text = re.sub(r"[,;:]+\s*([.!?])", r"\1", text)
+    text = re.sub(r"^[\s,;:.]+", "", text)
+    if replacements is not None:
+        pattern, mapping = replacements
+        text = pattern.sub(lambda m: mapping[m.group(0).casefold()], text)
+    text = re.sub(r"\bi\b(?!\.\w)", "I", text)  # "i", "i'm", but not "i.e."
+    text = SENTENCE_START.sub(capitalize_sentence, text)
+    text = text.rstrip(",;: ")
+    if text and text[-1] not in ".!?…\"')":
+        text += "."
+    return text
+
+
+def cleanup_needs_llm(transcription, normalized):
+    """Whether the remote LLM should clean up a transcript, or the local normalizer's result is good enough."""
+    if LOCAL_CLEANUP != "auto":
+        return LOCAL_CLEANUP == "off"
+    words = len(normalized.split())
+    if words <= LOCAL_CLEANUP_SHORT_WORDS:
+        return False
+    already_clean = normalized == " ".join(transcription.split())
+    return not (already_clean and words <= LOCAL_CLEANUP_CLEAN_WORDS)
+
+
+# Cleanup providers in fallback order: (name, API key, model, function)
+LLM_PROVIDERS = (
+    ("Cerebras", CEREBRAS_API_KEY, CEREBRAS_MODEL, clean_with_cerebras),
+    ("OpenAI", OPENAI_API_KEY, OPENAI_MODEL, clean_with_openai),
+)
+
+
+async def clean_with_providers(prompt, providers, words, deadline, stream):
+    """Run the cleanup prompt on the fastest healthy provider, falling back to the others.
+
+    Returns (text, provider name), or (None, None) when every provider failed.
+    """
+    names = router.order(list(providers), words)
+    for index, name in enumerate(names):
+        if index > 0:
+            metrics.inc("voiceflow_fallbacks", kind="llm")
+        timeout = attempt_timeout(name, words, deadline, len(names) - index - 1)
+        start = time.monotonic()
         try:
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
-                json={
-                    "model": "gpt-4",
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": ("You are a helpful assistant that improves transcriptions."),
-                        },
-                        {"role": "user", "content": prompt},
-                    ],
-                },
-                timeout=30,
-            )
-            response.raise_for_status()
-            processed_text = response.json()["choices"][0]["message"]["content"]
-        except requests.RequestException as e:
-            logger.error("OpenAI API error: %s", e)
-            return None
+            with stage("llm", name, timeout=round(timeout, 3)):
+                text = await providers[name](prompt, timeout, stream.feed if stream else None)
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            logger.error("%s API error: %s", name, e)
+            router.record_failure(name)
+            if stream is not None and stream.text:
+                # Sentences already inserted can't be taken back, so don't start over elsewhere.
+                logger.error("%s stream broke off after %d characters, output is incomplete", name, len(stream.text))
+                return stream.text, None
+            continue
+        router.record_success(name, time.monotonic() - start, words)
+        return text, name
+    return None, None
+
+
+async def process_transcription_async(transcription, deadline=None, on_text=None):
+    """Clean up the transcription locally or, when that is not enough, with the fastest healthy LLM provider.
+
+    The transcript is normalized locally first; cleanup_needs_llm() decides
+    whether that is the final text. Otherwise the normalized transcript is
+    looked up in the cleanup cache and then sent to the LLM providers, which
+    share `deadline` (by default a fresh budget for the cleanup alone). The
+    cleaned text is returned and, if given, written to `on_text`: sentence by
+    sentence while it streams in, or all at once otherwise. When every
+    provider fails, the locally normalized transcript is used instead. An
+    empty string means nothing was left after removing filler words.
+    """
+    normalized = normalize_transcript(transcription)
+    if not normalized:
+        return ""
+    configured = {
+        name: (model, clean) for name, api_key, model, clean in LLM_PROVIDERS if api_key and LOCAL_ASR != "only"
+    }
+    cleanup_stats["transcripts"] += 1
+    stream = None
+    if not configured or not cleanup_needs_llm(transcription, normalized):
+        cleanup_stats["local"] += 1
+        logger.info(
+            f"Cleaned up locally, skipping the LLM "
+            f"({cleanup_stats['local']} of {cleanup_stats['transcripts']} transcripts so far)"
+        )
+        processed_text = normalized
+    else:
+        prompt = CLEANUP_PROMPT.format(transcript=normalized)
+        logger.debug("Prompt for LLM: %s", prompt)
+
+        words = len(normalized.split())
+        cache_keys = {}
+        processed_text = None
+        if cleanup_cache is not None and words <= CLEANUP_CACHE_MAX_WORDS:
+            cache_keys = {
+                name: CleanupCache.key(normalized, CLEANUP_PROMPT, model) for name, (model, _) in configured.items()
+            }
+            start = time.perf_counter()
+            processed_text = cleanup_cache.lookup(cache_keys.values())
+            if processed_text is not None:
+                stats = cleanup_cache.stats()
+                logger.info(
+                    f"Cleanup cache hit in {(time.perf_counter() - start) * 1e6:.0f} µs "
+                    f"({stats['hits']} hits, {stats['misses']} misses)"
+                )
 
-    logger.info("Raw LLM output: %s", processed_text)
-    print(f"Raw LLM output: {processed_text}")  # Console output
+        if processed_text is None:
+            if deadline is None:
+                expected = router.best_expected_latency(list(configured), words)
+                expected = expected or words * DEFAULT_LLM_SECONDS_PER_WORD
+                deadline = Deadline(DEADLINE_BASE + DEADLINE_SLACK * expected)
+            stream = SentenceStream(on_text) if STREAM_CLEANUP and on_text is not None else None
+            providers = {name: clean for name, (_, clean) in configured.items()}
+            processed_text, name = await clean_with_providers(prompt, providers, words, deadline, stream)
+            if processed_text is None:
+                # Nothing was streamed, so the local cleanup can still stand in.
+                logger.warning("LLM cleanup failed with every provider, using the locally cleaned transcript")
+                processed_text = normalized
+            elif name in cache_keys:
+                await asyncio.to_thread(cleanup_cache.put, cache_keys[name], processed_text)
+
+        logger.debug("Raw LLM output: %s", processed_text)
 
     # Check if the processed text has more than one sentence
     sentences = re.split(r"(?<=[.!?])\s+", processed_text.strip())
-    if len(sentences) > 1:
-        processed_text += "\n"  # Add an extra newline if there's more than one sentence
+    suffix = "\n" if len(sentences) > 1 else ""  # Add an extra newline if there's more than one sentence
+    processed_text += suffix
+    if stream is not None and stream.text:
+        stream.close(suffix)
+    elif on_text is not None:
+        on_text(processed_text)
 
-    logger.info("Final processed text: %s", processed_text)
-    print(f"Final processed text: {processed_text}")  # Console output
+    logger.debug("Final processed text: %s", processed_text)
 
     return processed_text
 
 
+def process_transcription(transcription, deadline=None, on_text=None):
+    return pipeline_loop.run(process_transcription_async(transcription, deadline, on_text))
+
+
 def insert_text_into_active_window(text):
-    """Insert the processed text into the active window using xclip and xdotool."""
+    """Insert the processed text into the active window using xclip and xdotool.
+
+    Fallback for when X11Output is not available; spawns two processes.
+    """
     try:
-        logger.info("Attempting to paste text: %s", text)
+        logger.debug("Attempting to paste text: %s", text)
         # Copy the text to clipboard
-        subprocess.run(
-            ["xclip", "-selection", "clipboard"],
-            input=text.encode("utf-8"),
-            check=True,
-        )
+        with stage("clipboard"):
+            xclip_paste_gate.wait()
+            subprocess.run(
+                ["xclip", "-selection", "clipboard"],
+                input=text.encode("utf-8"),
+                check=True,
+            )
 
         # Simulate Ctrl+V to paste
-        subprocess.run(["xdotool", "key", "--clearmodifiers", "ctrl+v"], check=True)
+        with stage("paste"):
+            subprocess.run(["xdotool", "key", "--clearmodifiers", "ctrl+v"], check=True)
+            xclip_paste_gate.expect()
 
         logger.info("Text pasted into active window successfully")
     except subprocess.CalledProcessError as e:
@@ -382,7 +2841,7 @@ def check_permissions():
         stream = p.open(
             format=FORMAT,
             channels=CHANNELS,
-            rate=RATE,
+            rate=capture_rate,
             input=True,
             frames_per_buffer=CHUNK,
         )
@@ -406,12 +2865,43 @@ def obtain_lock():
     try:
         fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
     except IOError:
-        print("Another instance is already running. Exiting.")
+        logger.error("Another instance is already running. Exiting.")
         sys.exit(1)
     return lock_file
 
 
+def benchmark_local_asr(path, models):
+    """Print the real-time factor of each local model on this CPU for a mono 16-bit WAV file."""
+    if WhisperModel is None:
+        sys.exit("faster-whisper is not installed")
+    with wave.open(path) as wav:
+        if wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+            sys.exit("Expected a mono 16-bit WAV file")
+        rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+    if rate != TARGET_RATE:
+        frames = StreamingResampler(rate, TARGET_RATE).process(frames)
+    samples = np.frombuffer(frames, dtype=np.int16)
+    seconds = len(samples) / TARGET_RATE
+
+    print(f"{path}: {seconds:.1f}s of audio, {os.cpu_count()} CPUs")
+    for model in models:
+        transcriber = LocalTranscriber(model, LOCAL_ASR_THREADS)
+        start = time.monotonic()
+        transcriber.load()
+        load_time = time.monotonic() - start
+        transcriber.transcribe(samples[:TARGET_RATE])  # Warm-up
+        start = time.monotonic()
+        text = transcriber.transcribe(samples)
+        elapsed = time.monotonic() - start
+        print(f"{model}: RTF {elapsed / seconds:.3f} ({elapsed:.2f}s, model load {load_time:.1f}s): {text}")
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--benchmark-local-asr":
+        benchmark_local_asr(sys.argv[2], sys.argv[3:] or ["tiny.en", "base.en", "small.en"])
+        sys.exit(0)
+
     lock = obtain_lock()
     logger.info("Starting VoiceFlow")
     if not check_permissions():
@@ -419,17 +2909,30 @@ if __name__ == "__main__":
         sys.exit(1)
 
     # Modified API key validation
-    if not (FIREWORKS_API_KEY or GROQ_API_KEY):
+    if not (FIREWORKS_API_KEY or GROQ_API_KEY or local_transcriber):
         logger.error(
             "Missing required API keys. Please set either FIREWORKS_API_KEY or "
             "GROQ_API_KEY as environment variables."
         )
         sys.exit(1)
+    if local_transcriber:
+        # Load the model in the background so the first dictation doesn't wait for it
+        threading.Thread(target=local_transcriber.load, name="local-asr-load", daemon=True).start()
+
+    pipeline_loop.start()
+    capture_service.start()
+    capture_service.warm_up()
+    connection_warmer.start()
+    processing_worker.start()
 
     # Set up the keyboard listener
     listener = keyboard.Listener(on_press=on_press, on_release=on_release)
     listener.start()
     logger.info("Keyboard listener started. Press Alt+T to start/stop recording.")
+    signal.signal(signal.SIGUSR1, lambda signum, frame: latency_stats.log_summary())
+    metrics_server = MetricsServer(METRICS_PORT, render_metrics) if METRICS_PORT else None
+    if metrics_server is not None:
+        metrics_server.start()
 
     try:
         # Keep the script running
@@ -440,3 +2943,14 @@ if __name__ == "__main__":
     finally:
         listener.stop()
         logger.info("Keyboard listener stopped.")
+        capture_service.shutdown()
+        processing_worker.shutdown()
+        output_executor.shutdown()
+        router.save()
+        if cleanup_cache is not None:
+            cleanup_cache.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        pipeline_loop.shutdown()
+        if trace_writer is not None:
+            trace_writer.close()
@@ -0,0 +1,364 @@
+"""Tests for the audio and text helpers in voiceflow.py.
+
+Importing voiceflow needs its runtime dependencies (PyAudio, and an X display
+for pynput). Run from the repository root with:
+
+    python -m unittest discover -s tests
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import httpx
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("VOICEFLOW_CLEANUP_CACHE_SIZE", "0")  # Don't create voiceflow_cache.db
+
+import voiceflow  # noqa: E402
+
+RATE = voiceflow.TARGET_RATE
+
+
+def tone(seconds, dbfs, modulation_db=0.0, hz=220):
+    """A sine at `dbfs` RMS with brief dips of `modulation_db` between syllables, four per second."""
+    t = np.arange(int(seconds * RATE)) / RATE
+    level_db = dbfs - modulation_db * ((1 - np.cos(2 * np.pi * 4 * t)) / 2) ** 16
+    amplitude = np.sqrt(2) * 32768 * 10 ** (level_db / 20)
+    return (amplitude * np.sin(2 * np.pi * hz * t)).astype(np.int16)
+
+
+def noise(seconds, dbfs, seed=0):
+    samples = np.random.default_rng(seed).normal(0, 32768 * 10 ** (dbfs / 20), int(seconds * RATE))
+    return samples.astype(np.int16)
+
+
+class TrimSilenceTest(unittest.TestCase):
+    def test_loud_speech_without_pauses_is_kept(self):
+        for seconds in (0.8, 1.5, 3.0):
+            samples = tone(seconds, -20, modulation_db=14)
+            trimmed = voiceflow.trim_silence(samples, RATE)
+            self.assertIsNotNone(trimmed, f"{seconds}s clip")
+            self.assertGreaterEqual(len(trimmed), len(samples) * 0.9)
+
+    def test_silence_is_dropped(self):
+        self.assertIsNone(voiceflow.trim_silence(np.zeros(RATE * 2, dtype=np.int16), RATE))
+        self.assertIsNone(voiceflow.trim_silence(noise(2, -70), RATE))
+
+    def test_quiet_background_is_trimmed(self):
+        samples = np.concatenate((noise(1, -65, seed=1), tone(1, -25, modulation_db=10), noise(1, -65, seed=2)))
+        trimmed = voiceflow.trim_silence(samples, RATE)
+        self.assertIsNotNone(trimmed)
+        self.assertLess(len(trimmed), len(samples) * 0.7)
+
+    def test_short_loud_clip_is_uploaded_untrimmed(self):
+        samples = np.concatenate((np.zeros(RATE, dtype=np.int16), tone(0.1, -20), np.zeros(RATE, dtype=np.int16)))
+        trimmed = voiceflow.trim_silence(samples, RATE)
+        self.assertIsNotNone(trimmed)
+        self.assertEqual(len(trimmed), len(samples))
+
+
+class ExpectedLatencyTest(unittest.TestCase):
+    def test_short_clip_after_long_ones_keeps_the_overhead(self):
+        stats = voiceflow.ProviderStats("Test")
+        for _ in range(10):
+            stats.record_success(0.6 + 0.02 * 30, 30)
+        self.assertGreaterEqual(stats.expected_latency(1), 1.0)
+        self.assertGreater(stats.expected_latency(60), stats.expected_latency(30))
+
+    def test_overhead_and_rate_are_fitted(self):
+        stats = voiceflow.ProviderStats("Test")
+        for seconds in (1, 5, 10, 20, 40, 60):
+            stats.record_success(0.6 + 0.02 * seconds, seconds)
+        self.assertAlmostEqual(stats.expected_latency(1), 0.62)
+        self.assertAlmostEqual(stats.expected_latency(100), 2.6)
+        self.assertAlmostEqual(stats.slowdown_percentile(90), 1.0)
+
+
+class MetricsRenderTest(unittest.TestCase):
+    def test_render_is_openmetrics_text(self):
+        metrics = voiceflow.Metrics()
+        metrics.describe("requests", "counter", "Requests.")
+        metrics.describe("depth", "gauge", "Queue depth.")
+        metrics.describe("latency_seconds", "histogram", "Latency.", (1, 5))
+        metrics.inc("requests", provider="Groq")
+        metrics.inc("requests", 2, provider="Groq")
+        metrics.set("depth", 4)
+        for value in (0.5, 0.5, 3, 9):
+            metrics.observe("latency_seconds", value, stage="asr")
+        self.assertEqual(
+            metrics.render(),
+            "# TYPE requests counter\n"
+            "# HELP requests Requests.\n"
+            'requests_total{provider="Groq"} 3\n'
+            "# TYPE depth gauge\n"
+            "# HELP depth Queue depth.\n"
+            "depth 4\n"
+            "# TYPE latency_seconds histogram\n"
+            "# HELP latency_seconds Latency.\n"
+            'latency_seconds_bucket{stage="asr",le="1.0"} 2\n'
+            'latency_seconds_bucket{stage="asr",le="5.0"} 3\n'
+            'latency_seconds_bucket{stage="asr",le="+Inf"} 4\n'
+            'latency_seconds_count{stage="asr"} 4\n'
+            'latency_seconds_sum{stage="asr"} 13.0\n'
+            "# EOF\n",
+        )
+
+    def test_label_values_are_escaped(self):
+        metrics = voiceflow.Metrics()
+        metrics.describe("errors", "counter", "Errors.")
+        metrics.inc("errors", reason='bad "quote"\\\n')
+        self.assertIn('errors_total{reason="bad \\"quote\\"\\\\\\n"} 1\n', metrics.render())
+
+    def test_empty_registry_ends_with_eof(self):
+        self.assertEqual(voiceflow.Metrics().render(), "# EOF\n")
+
+
+class RouterOrderTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.router = voiceflow.ProviderRouter(os.path.join(directory.name, "router.json"))
+
+    def test_one_failure_without_history_keeps_the_configured_order(self):
+        self.router.record_failure("Fireworks")
+        self.router.record_success("Groq", 0.5, 3)
+        self.assertEqual(self.router.order(["Fireworks", "Groq"], 3), ["Fireworks", "Groq"])
+
+    def test_failures_count_against_the_rank_until_they_fade(self):
+        self.router.record_success("Fireworks", 0.4, 3)
+        self.router.record_success("Groq", 0.5, 3)
+        self.assertEqual(self.router.order(["Groq", "Fireworks"], 3), ["Fireworks", "Groq"])
+        self.router.record_failure("Fireworks")
+        self.router.record_failure("Fireworks")
+        self.assertEqual(self.router.order(["Fireworks", "Groq"], 3), ["Groq", "Fireworks"])
+        self.router.stats("Fireworks").failed_at -= 10 * voiceflow.ROUTER_ERROR_HALF_LIFE
+        self.assertEqual(self.router.order(["Fireworks", "Groq"], 3), ["Fireworks", "Groq"])
+
+    def test_rank_depends_on_the_request_size(self):
+        for seconds in (1, 5, 10, 20, 40, 60):
+            self.router.record_success("Fireworks", 0.2 + 0.05 * seconds, seconds)  # Quick to start, slow per second
+            self.router.record_success("Groq", 1.0 + 0.01 * seconds, seconds)
+        self.assertEqual(self.router.order(["Groq", "Fireworks"], 2), ["Fireworks", "Groq"])
+        self.assertEqual(self.router.order(["Fireworks", "Groq"], 60), ["Groq", "Fireworks"])
+
+    def test_best_expected_latency_includes_the_overhead(self):
+        self.assertIsNone(self.router.best_expected_latency(["Fireworks"], 5))
+        for seconds in (1, 5, 10, 20, 40, 60):
+            self.router.record_success("Fireworks", 0.6 + 0.02 * seconds, seconds)
+            self.router.record_success("Groq", 1.0 + 0.01 * seconds, seconds)
+        self.assertAlmostEqual(self.router.best_expected_latency(["Fireworks", "Groq"], 1), 0.62)
+        self.assertAlmostEqual(self.router.best_expected_latency(["Fireworks", "Groq"], 100), 2.0)
+        for _ in range(voiceflow.CIRCUIT_FAILURES):
+            self.router.record_failure("Fireworks")
+        self.assertAlmostEqual(self.router.best_expected_latency(["Fireworks", "Groq"], 1), 1.01)
+
+
+class NormalizeTranscriptTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(voiceflow, "replacements", None)  # Ignore a local replacements file
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertNormalized(self, text, expected):
+        self.assertEqual(voiceflow.normalize_transcript(text), expected)
+
+    def test_fillers_are_removed(self):
+        self.assertNormalized("um so, uh, we should mhm go", "So, we should go.")
+        self.assertNormalized("hmm, mmm okay", "Okay.")
+        self.assertNormalized("um", "")
+
+    def test_words_that_look_like_fillers_are_kept(self):
+        self.assertNormalized("a 5 mm screw", "A 5 mm screw.")
+        self.assertNormalized("the mm-wave band", "The mm-wave band.")
+        self.assertNormalized("uh-huh that works", "Uh-huh that works.")
+
+    def test_sentences_are_capitalized(self):
+        self.assertNormalized("it works. then what", "It works. Then what.")
+        self.assertNormalized("i think i'm done", "I think I'm done.")
+
+    def test_abbreviations_do_not_end_sentences(self):
+        self.assertNormalized("meet at 3.5 p.m. tomorrow", "Meet at 3.5 p.m. tomorrow.")
+        self.assertNormalized("e.g. this one", "E.g. this one.")
+        self.assertNormalized("ask dr. smith", "Ask dr. smith.")
+
+
+class CleanupFallbackTest(unittest.TestCase):
+    def test_local_cleanup_is_used_when_every_provider_fails(self):
+        providers = (("Test", "key", "model", None),)
+        failed = mock.AsyncMock(return_value=(None, None))
+        written = []
+        with (
+            mock.patch.object(voiceflow, "LLM_PROVIDERS", providers),
+            mock.patch.object(voiceflow, "LOCAL_ASR", "off"),
+            mock.patch.object(voiceflow, "LOCAL_CLEANUP", "off"),
+            mock.patch.object(voiceflow, "cleanup_cache", None),
+            mock.patch.object(voiceflow, "replacements", None),
+            mock.patch.object(voiceflow, "clean_with_providers", failed),
+        ):
+            deadline = voiceflow.Deadline(5)
+            text = asyncio.run(voiceflow.process_transcription_async("um it works", deadline, written.append))
+        failed.assert_awaited_once()
+        self.assertEqual(text, "It works.")
+        self.assertEqual(written, ["It works."])
+
+
+class CleanupCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "cache.db")
+        clock = mock.patch.object(voiceflow.time, "time", side_effect=itertools.count(1000))  # Distinct timestamps
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def open(self, size):
+        cache = voiceflow.CleanupCache(size, self.path)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_key_ignores_case_and_spacing_but_not_prompt_or_model(self):
+        key = voiceflow.CleanupCache.key("Hello  world", "prompt", "model")
+        self.assertEqual(key, voiceflow.CleanupCache.key(" hello world ", "prompt", "model"))
+        self.assertNotEqual(key, voiceflow.CleanupCache.key("hello world", "other prompt", "model"))
+        self.assertNotEqual(key, voiceflow.CleanupCache.key("hello world", "prompt", "other model"))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = voiceflow.CleanupCache(2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        self.assertEqual(cache.lookup(["a"]), "A")
+        cache.put("c", "C")
+        self.assertIsNone(cache.lookup(["b"]))
+        self.assertEqual(cache.lookup(["missing", "c"]), "C")
+        self.assertEqual(cache.lookup(["a"]), "A")
+        self.assertEqual(cache.stats(), {"entries": 2, "hits": 3, "misses": 1, "hit_rate": 0.75})
+
+    def test_empty_cache_has_no_hit_rate(self):
+        self.assertEqual(voiceflow.CleanupCache(2).stats(), {"entries": 0, "hits": 0, "misses": 0, "hit_rate": None})
+
+    def test_hits_keep_entries_in_the_database(self):
+        cache = self.open(2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        cache.lookup(["a"])  # Only in memory until the next write
+        cache.put("c", "C")
+        cache.close()
+        cache = self.open(2)
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertIsNone(cache.lookup(["b"]))
+        self.assertEqual(cache.lookup(["a"]), "A")
+        self.assertEqual(cache.lookup(["c"]), "C")
+
+    def test_most_recently_used_entries_are_loaded(self):
+        cache = self.open(3)
+        for key in "abc":
+            cache.put(key, key.upper())
+        cache.lookup(["a"])
+        cache.close()  # Saves the hit
+        cache = self.open(2)
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertIsNone(cache.lookup(["b"]))
+        cache.put("d", "D")  # Evicts c, the least recently used of the loaded entries
+        self.assertIsNone(cache.lookup(["c"]))
+        self.assertEqual(cache.lookup(["a"]), "A")
+
+
+class OutputSequencerTest(unittest.TestCase):
+    def test_later_job_is_done_only_after_its_held_text_is_written(self):
+        events = []
+        sequencer = voiceflow.OutputSequencer(lambda text: events.append(("write", text)))
+        sequencer.emit(1, "second")
+        sequencer.close(1, lambda: events.append(("done", 1)))
+        self.assertEqual(events, [])
+        sequencer.emit(0, "first")
+        sequencer.close(0, lambda: events.append(("done", 0)))
+        self.assertEqual(events, [("write", "first"), ("done", 0), ("write", "second"), ("done", 1)])
+
+
+class StreamedPasteTest(unittest.TestCase):
+    def test_sentences_written_back_to_back_are_all_pasted(self):
+        gate = voiceflow.PasteGate(timeout=2.0)
+        clipboard, pasted, requests = [None], [], []
+        done = threading.Event()
+
+        def window():
+            # Reads the clipboard some time after each Ctrl+V, like a real X client.
+            while not done.is_set() or requests:
+                if requests:
+                    requests.pop(0)
+                    time.sleep(0.05)
+                    pasted.append(clipboard[0])
+                    gate.fetched()
+                else:
+                    time.sleep(0.001)
+
+        def paste(text):
+            gate.wait()
+            clipboard[0] = text
+            gate.expect()
+            requests.append(text)
+
+        thread = threading.Thread(target=window)
+        thread.start()
+        stream = voiceflow.SentenceStream(paste)
+        for delta in ("One. ", "Two. ", "Three"):
+            stream.feed(delta)
+        stream.close("\n")
+        gate.wait()
+        done.set()
+        thread.join()
+        self.assertEqual(pasted, ["One. ", "Two. ", "Three\n"])
+
+    def test_unfetched_paste_is_only_waited_for_until_the_timeout(self):
+        gate = voiceflow.PasteGate(timeout=0.05)
+        gate.expect()
+        start = time.monotonic()
+        gate.wait()
+        self.assertLess(time.monotonic() - start, 1.0)
+
+
+class ChatCompletionTest(unittest.TestCase):
+    def complete(self, handler, on_delta=None):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with mock.patch.object(voiceflow, "http_client", client):
+            return asyncio.run(voiceflow.chat_completion("https://llm.test/v1/chat", {}, {"model": "m"}, 5, on_delta))
+
+    def test_stream_is_parsed_as_server_sent_events(self):
+        def handler(request):
+            self.assertTrue(json.loads(request.content)["stream"])
+            events = [{"choices": [{"delta": {"role": "assistant"}}]}]
+            events += [{"choices": [{"delta": {"content": text}}]} for text in ("Hello", " there.", " Bye.")]
+            body = ": keep-alive\n\n" + "".join(f"data: {json.dumps(event)}\n\n" for event in events)
+            body += "data: [DONE]\n\ndata: {not json after the end}\n\n"
+            return httpx.Response(200, text=body, headers={"Content-Type": "text/event-stream"})
+
+        deltas = []
+        self.assertEqual(self.complete(handler, deltas.append), "Hello there. Bye.")
+        self.assertEqual(deltas, ["Hello", " there.", " Bye."])
+
+    def test_without_on_delta_the_whole_message_is_returned(self):
+        def handler(request):
+            self.assertNotIn("stream", json.loads(request.content))
+            return httpx.Response(200, json={"choices": [{"message": {"content": "Hello."}}]})
+
+        self.assertEqual(self.complete(handler), "Hello.")
+
+    def test_error_status_raises(self):
+        def handler(request):
+            return httpx.Response(503, text="overloaded")
+
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.complete(handler, lambda delta: None)
+
+
+if __name__ == "__main__":
+    unittest.main()